@@ -8,13 +8,35 @@ Web-приложение EPUB Cutter
 import os
 import sqlite3
 import zipfile
+import queue
+import threading
+from contextlib import contextmanager
+from functools import wraps
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, send_from_directory, redirect, url_for, flash, send_file
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user
+from flask import Flask, render_template, request, jsonify, send_from_directory, redirect, url_for, flash, send_file, g, session, has_request_context
+from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.utils import secure_filename
 import sys
 import tempfile
 import io
+import json
+import uuid
+import click
+import time
+import bisect
+import random
+import cProfile
+import pstats
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Pillow нужен только для миниатюр обложек: без него каталог показывается без обложек
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # Функции для работы с метаданными (перенесены из metadata_utils)
 def extract_epub_metadata(opf_root):
@@ -37,15 +59,324 @@ def extract_epub_metadata(opf_root):
     
     return title.strip(), author.strip()
 
+# Проверка архива EPUB до распаковки
+EPUB_RATIO_MIN_SIZE = 1024 * 1024  # Маленькие файлы могут сжиматься очень сильно и без подвоха
+
+class EPUBLimitError(ValueError):
+    """EPUB превышает допустимые размеры (возможна zip-бомба)"""
+
+def format_megabytes(size):
+    """Размер в мегабайтах для сообщений об ошибках"""
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+def check_epub_archive(epub_zip):
+    """Проверяет центральный каталог zip до распаковки: число файлов,
+    распакованный размер каждого файла и всего архива, степень сжатия (EPUB_MAX_*)
+    """
+    entries = epub_zip.infolist()
+    if len(entries) > app.config['EPUB_MAX_ENTRIES']:
+        raise EPUBLimitError(f"В EPUB {len(entries)} файлов, допускается не более {app.config['EPUB_MAX_ENTRIES']}")
+    
+    total_size = 0
+    for entry in entries:
+        if entry.file_size > app.config['EPUB_MAX_ENTRY_SIZE']:
+            raise EPUBLimitError(
+                f"Файл {entry.filename} в EPUB занимает {format_megabytes(entry.file_size)} после распаковки, "
+                f"допускается не более {format_megabytes(app.config['EPUB_MAX_ENTRY_SIZE'])}"
+            )
+        if entry.file_size >= EPUB_RATIO_MIN_SIZE:
+            ratio = entry.file_size / max(entry.compress_size, 1)
+            if ratio > app.config['EPUB_MAX_COMPRESSION_RATIO']:
+                raise EPUBLimitError(
+                    f"Файл {entry.filename} в EPUB сжат в {ratio:.0f} раз, "
+                    f"допускается не более {app.config['EPUB_MAX_COMPRESSION_RATIO']}"
+                )
+        total_size += entry.file_size
+    
+    if total_size > app.config['EPUB_MAX_TOTAL_SIZE']:
+        raise EPUBLimitError(
+            f"EPUB занимает {format_megabytes(total_size)} после распаковки, "
+            f"допускается не более {format_megabytes(app.config['EPUB_MAX_TOTAL_SIZE'])}"
+        )
+
+def read_epub_entry(epub_zip, name):
+    """Читает файл из EPUB потоком, прерываясь, если данных больше заявленного или EPUB_MAX_ENTRY_SIZE"""
+    limit = min(epub_zip.getinfo(name).file_size, app.config['EPUB_MAX_ENTRY_SIZE'])
+    chunks = []
+    size = 0
+    with epub_zip.open(name) as entry:
+        while True:
+            chunk = entry.read(64 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > limit:
+                raise EPUBLimitError(f"Файл {name} в EPUB больше заявленного размера")
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+# Оглавление из навигации EPUB: узлы {'title', 'file_path', 'fragment', 'children'}
+XHTML_NS = '{http://www.w3.org/1999/xhtml}'
+EPUB_OPS_NS = '{http://www.idpf.org/2007/ops}'
+NCX_NS = '{http://www.daisy.org/z3986/2005/ncx/}'
+
+def resolve_toc_href(base_dir, href):
+    """Путь файла внутри EPUB и якорь для ссылки из оглавления (внешние ссылки - (None, None))"""
+    import posixpath
+    from urllib.parse import unquote
+    
+    if not href or '://' in href or href.startswith('mailto:'):
+        return None, None
+    path, _, fragment = href.partition('#')
+    if not path:
+        return None, None
+    return posixpath.normpath(posixpath.join(base_dir, unquote(path))), fragment or None
+
+def toc_label(element):
+    """Текст подписи пункта оглавления без лишних пробелов"""
+    return ' '.join(''.join(element.itertext()).split()) if element is not None else ''
+
+def parse_nav_toc(nav_root, base_dir):
+    """Оглавление из навигационного документа EPUB 3 (<nav epub:type="toc">)"""
+    navs = list(nav_root.iter(f'{XHTML_NS}nav'))
+    toc_nav = next((nav for nav in navs if 'toc' in (nav.get(f'{EPUB_OPS_NS}type') or '').split()),
+                   navs[0] if navs else None)
+    if toc_nav is None or toc_nav.find(f'{XHTML_NS}ol') is None:
+        return []
+    
+    def parse_list(ol):
+        entries = []
+        for li in ol.findall(f'{XHTML_NS}li'):
+            label = li.find(f'{XHTML_NS}a')
+            if label is None:
+                label = li.find(f'{XHTML_NS}span')
+            nested = li.find(f'{XHTML_NS}ol')
+            file_path, fragment = resolve_toc_href(base_dir, label.get('href') if label is not None else None)
+            entries.append({
+                'title': toc_label(label),
+                'file_path': file_path,
+                'fragment': fragment,
+                'children': parse_list(nested) if nested is not None else []
+            })
+        return entries
+    
+    return parse_list(toc_nav.find(f'{XHTML_NS}ol'))
+
+def parse_ncx_toc(ncx_root, base_dir):
+    """Оглавление из NCX файла EPUB 2 (navMap/navPoint)"""
+    nav_map = ncx_root.find(f'{NCX_NS}navMap')
+    if nav_map is None:
+        return []
+    
+    def parse_points(parent):
+        entries = []
+        for point in parent.findall(f'{NCX_NS}navPoint'):
+            content = point.find(f'{NCX_NS}content')
+            file_path, fragment = resolve_toc_href(base_dir, content.get('src') if content is not None else None)
+            entries.append({
+                'title': toc_label(point.find(f'{NCX_NS}navLabel/{NCX_NS}text')),
+                'file_path': file_path,
+                'fragment': fragment,
+                'children': parse_points(point)
+            })
+        return entries
+    
+    return parse_points(nav_map)
+
+def walk_toc(nodes):
+    """Обходит дерево оглавления в порядке документа"""
+    for node in nodes:
+        yield node
+        yield from walk_toc(node['children'])
+
 def format_book_info(title, author):
     """Форматирует информацию о книге для отображения"""
     return f"{title} - {author}"
 
+def chapter_filename(chapter_index, title):
+    """Имя HTML файла главы на сайте книги (как в create_website)"""
+    import re
+    safe_title = re.sub(r'[<>:"/\\|?*]', '', title)
+    return f"chapter_{chapter_index + 1:02d}_{safe_title}.html"
+
+def normalize_chapter_markup(content_str):
+    """Исправляет некорректные HTML комментарии главы для корректного XML
+    
+    Возвращает (содержимое в байтах, корень XML или None). Если и исправленный
+    текст не разбирается как XML, остается исходное содержимое.
+    """
+    import re
+    from xml.etree import ElementTree as ET
+    
+    fixed_content = re.sub(r'<!--\[endif\]---->', '<!--[endif]-->', content_str)
+    fixed_content = re.sub(r'<!--([^>]*?)---->', r'<!--\1-->', fixed_content)
+    try:
+        return fixed_content.encode('utf-8'), ET.fromstring(fixed_content.encode('utf-8'))
+    except Exception:
+        return content_str.encode('utf-8'), None
+
+def extract_plain_text(content):
+    """Извлекает из XHTML главы обычный текст для полнотекстового поиска"""
+    import re
+    from html import unescape
+    
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', errors='replace')
+    
+    body_match = re.search(r'<body[^>]*>(.*)</body>', content, re.DOTALL | re.IGNORECASE)
+    if body_match:
+        content = body_match.group(1)
+    
+    content = re.sub(r'<(script|style)[^>]*>.*?</\1>', ' ', content, flags=re.DOTALL | re.IGNORECASE)
+    content = re.sub(r'<!--.*?-->', ' ', content, flags=re.DOTALL)
+    content = re.sub(r'<[^>]+>', ' ', content)
+    return re.sub(r'\s+', ' ', unescape(content)).strip()
+
+def visible_text(content):
+    """Текст HTML так, как его видит читатель: без тегов и комментариев, с схлопнутыми пробелами"""
+    import re
+    from html import unescape
+    
+    content = re.sub(r'<(script|style)\b.*?</\1\s*>', '', content, flags=re.DOTALL | re.IGNORECASE)
+    content = re.sub(r'<!--.*?-->', '', content, flags=re.DOTALL)
+    content = re.sub(r'<[^>]+>', '', content)
+    return re.sub(r'[ \t\n\r\f]+', ' ', unescape(content)).strip()
+
+def minify_chapter_html(content):
+    """Убирает из HTML главы мусор экспорта из Word и лишние пробелы
+    
+    Удаляются комментарии (в том числе условные), пустые строчные элементы
+    без id, mso-стили и классы Mso*; пробелы схлопываются вне pre, textarea,
+    script и style. Неразрывные пробелы сохраняются.
+    """
+    import re
+    
+    # Фрагменты, где пробелы значимы, прячем на время обработки
+    preserved = []
+    
+    def preserve(match):
+        preserved.append(match.group(0))
+        return f'\x00{len(preserved) - 1}\x00'
+    
+    content = re.sub(r'<(pre|textarea|script|style)\b.*?</\1\s*>', preserve, content,
+                     flags=re.DOTALL | re.IGNORECASE)
+    
+    # Комментарии, включая условные <!--[if ...]>...<![endif]--> и "сломанные" ---->
+    content = re.sub(r'<!--.*?-->', '', content, flags=re.DOTALL)
+    # Условные блоки Word <![if !supportLists]>...<![endif]> (содержимое между ними видимо)
+    content = re.sub(r'<!\[(?:if [^\]]*|endif)\]>', '', content, flags=re.IGNORECASE)
+    
+    # Значение атрибута в кавычках (группы 1, 2) или без них, как часто пишет Word (группа 3)
+    attribute_value = r'=(?:(["\'])(.*?)\1|([^\s>"\']+))'
+    
+    def clean_style(match):
+        quote, value = match.group(1) or '"', match.group(2) if match.group(1) else match.group(3)
+        declarations = [d.strip() for d in value.split(';')
+                        if d.strip() and not d.strip().lower().startswith('mso-')]
+        return f' style={quote}{"; ".join(declarations)}{quote}' if declarations else ''
+    
+    def clean_class(match):
+        quote, value = match.group(1) or '"', match.group(2) if match.group(1) else match.group(3)
+        classes = [name for name in value.split() if not name.startswith('Mso')]
+        return f' class={quote}{" ".join(classes)}{quote}' if classes else ''
+    
+    def clean_tag(match):
+        tag = re.sub(r'\s+style' + attribute_value, clean_style, match.group(0), flags=re.IGNORECASE | re.DOTALL)
+        return re.sub(r'\s+class' + attribute_value, clean_class, tag, flags=re.IGNORECASE | re.DOTALL)
+    
+    content = re.sub(r'<[a-zA-Z][^>]*>', clean_tag, content)
+    
+    # Пустые строчные элементы; элементы с id/name остаются - на них могут вести ссылки
+    inline = r'span|font|b|i|u|em|strong|small|sub|sup|o:p'
+    empty_pattern = re.compile(rf'<({inline})\b([^>]*?)(?:/>|>([ \t\n\r\f]*)</\1\s*>)', re.IGNORECASE)
+    
+    def drop_empty(match):
+        if re.search(r'\b(id|name)\s*=', match.group(2)):
+            return match.group(0)
+        return ' ' if match.group(3) else ''
+    
+    # Повторяем, пока удаление вложенных пустых элементов что-то меняет
+    while True:
+        cleaned = empty_pattern.sub(drop_empty, content)
+        if cleaned == content:
+            break
+        content = cleaned
+    
+    # Схлопываем пробелы в тексте между тегами
+    parts = re.split(r'(<[^>]+>)', content)
+    content = ''.join(part if part.startswith('<') else re.sub(r'[ \t\n\r\f]+', ' ', part) for part in parts)
+    
+    return re.sub(r'\x00(\d+)\x00', lambda match: preserved[int(match.group(1))], content)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['BOOKS_FOLDER'] = 'books'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
+app.config['EPUB_MAX_ENTRIES'] = 10000  # Файлов в архиве EPUB
+app.config['EPUB_MAX_ENTRY_SIZE'] = 32 * 1024 * 1024  # Распакованный размер одного файла EPUB
+app.config['EPUB_MAX_TOTAL_SIZE'] = 256 * 1024 * 1024  # Распакованный размер всего EPUB
+app.config['EPUB_MAX_COMPRESSION_RATIO'] = 100  # Степень сжатия файла (проверяется для файлов от 1 МБ)
+app.config['DATABASE'] = 'books.db'
+app.config['DB_POOL_SIZE'] = 8  # Максимум одновременно открытых соединений с БД
+app.config['DB_BUSY_TIMEOUT'] = 5000  # мс ожидания блокировки БД
+app.config['DB_CACHE_SIZE'] = -16000  # Кэш страниц SQLite в КиБ (отрицательное значение)
+app.config['DB_MMAP_SIZE'] = 256 * 1024 * 1024  # Размер memory-mapped I/O
+app.config['CATALOG_PAGE_SIZE'] = 24  # Книг на одну страницу каталога
+app.config['CATALOG_CACHE_PAGES'] = 64  # Страниц каталога в кэше текущего поколения библиотеки
+app.config['NOTES_PAGE_SIZE'] = 50  # Заметок на одну страницу
+app.config['MAX_PAGE_SIZE'] = 200  # Верхняя граница параметра limit в API
+app.config['NOTES_BATCH_MAX_OPERATIONS'] = 500  # Максимум операций в одном пакете заметок
+app.config['EXPORT_WORKERS'] = 4  # Потоки экспорта глав одной книги в дочернем процессе
+app.config['BATCH_EXPORT_MAX_ITEMS'] = 100  # Максимум глав в одном пакетном экспорте
+app.config['OFFLINE_BOOK_MAX_BYTES'] = 200 * 1024 * 1024  # Книги больше не предлагается сохранять офлайн
+app.config['MINIFY_CHAPTERS'] = False  # Очистка и минификация HTML глав при создании сайта
+app.config['COVERS_FOLDER'] = 'covers'  # Миниатюры обложек (имена файлов - хэши содержимого)
+app.config['TRASH_REAP_INTERVAL'] = 60  # Секунд между проверками корзины удаленных книг
+app.config['TRASH_REAP_FILES_PER_SECOND'] = 500  # Ограничение скорости удаления файлов из корзины
+app.config['INGEST_CONCURRENCY'] = 2  # Одновременные загрузки книг
+app.config['INGEST_QUEUE_SIZE'] = 4  # Загрузки, ожидающие своей очереди
+app.config['EXPORT_CONCURRENCY'] = 4  # Одновременные экспорты глав
+app.config['EXPORT_QUEUE_SIZE'] = 16  # Экспорты, ожидающие своей очереди
+app.config['ADMISSION_QUEUE_TIMEOUT'] = 30  # Секунд ожидания в очереди до отказа
+app.config['ADMISSION_RETRY_AFTER'] = 10  # Значение заголовка Retry-After при перегрузке
+app.config['SANDBOX_ENABLED'] = True  # Загрузка и экспорт книг в дочерних процессах с лимитами
+app.config['INGEST_TIMEOUT'] = 300  # Секунд на обработку загруженной книги
+app.config['EXPORT_TIMEOUT'] = 60  # Секунд на экспорт глав одной книги
+app.config['SANDBOX_CPU_LIMIT'] = 300  # Секунд процессорного времени дочернего процесса (RLIMIT_CPU)
+app.config['SANDBOX_MEMORY_LIMIT'] = 2 * 1024 * 1024 * 1024  # Адресное пространство дочернего процесса (RLIMIT_AS)
+app.config['METRICS_TOKEN'] = None  # Если задан, /metrics доступен и без входа по заголовку Authorization: Bearer <токен>
+app.config['PROFILING_ENABLED'] = False  # Профилирование запросов через cProfile
+app.config['PROFILING_SAMPLE_RATES'] = {  # Доля профилируемых запросов по имени маршрута (endpoint)
+    'upload_book': 1.0,
+    'download_chapter': 0.1,
+    'batch_export': 0.1,
+    'view_book': 0.01,
+    'book_file': 0.01,
+}
+app.config['PROFILES_FOLDER'] = 'profiles'  # Куда сохраняются профили
+app.config['PROFILING_TOP_N'] = 40  # Строк в текстовой сводке профиля
+app.config['PROFILES_KEEP'] = 200  # Сколько последних профилей хранить
+
+# Имя копии исходного EPUB внутри папки сайта книги (нужна для экспорта глав)
+SOURCE_EPUB_NAME = 'source.epub'
+
+# Service worker сайта книги: шаблон и имя файла в папке сайта
+SERVICE_WORKER_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'js', 'book-sw.js')
+SERVICE_WORKER_NAME = 'sw.js'
+
+# Размеры миниатюр обложек (вписываются в прямоугольник): обычная и для экранов высокой плотности
+COVER_SIZES = {
+    'small': (160, 240),
+    'large': (320, 480),
+}
+COVER_CACHE_MAX_AGE = 365 * 24 * 3600  # Миниатюры неизменны, кэшируются на год
+
+# Поддерживаемые форматы экспорта глав: формат -> (MIME тип, метод EPUBProcessor)
+EXPORT_FORMATS = {
+    'epub': ('application/epub+zip', 'export_chapter_to_epub'),
+    'docx': ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'export_chapter_to_docx'),
+}
 
 # Настройка Flask-Login
 login_manager = LoginManager()
@@ -71,6 +402,303 @@ def load_user(user_id):
 # Убеждаемся, что папки существуют
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['BOOKS_FOLDER'], exist_ok=True)
+os.makedirs(app.config['COVERS_FOLDER'], exist_ok=True)
+
+# Метрики в текстовом формате Prometheus
+# Обновление метрики - словарь под блокировкой; текст формируется только при запросе /metrics
+def _format_labels(pairs):
+    """Форматирует метки сэмпла: {name="value",...}"""
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def _format_value(value):
+    """Форматирует значение сэмпла"""
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Базовая метрика: значения хранятся по кортежу значений меток"""
+    type_name = 'untyped'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+    
+    def _pairs(self, key):
+        return list(zip(self.labelnames, key))
+    
+    def collect(self):
+        """Список сэмплов (имя, метки, значение)"""
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, self._pairs(key), value) for key, value in items]
+    
+    def snapshot(self):
+        """Копия накопленных значений (для передачи из дочернего процесса)"""
+        import copy
+        with self._lock:
+            return copy.deepcopy(self._values)
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+    type_name = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def merge(self, values):
+        """Добавляет значения из snapshot() другого процесса"""
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+class CallbackMetric(Metric):
+    """Метрика, значения которой вычисляются функцией в момент сбора"""
+    
+    def __init__(self, name, documentation, labelnames, callback, type_name='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type_name = type_name
+    
+    def collect(self):
+        return [(self.name, self._pairs(key), value) for key, value in self.callback().items()]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram(Metric):
+    """Гистограмма длительностей с фиксированными границами корзин"""
+    type_name = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [счетчики корзин (последняя - +Inf), сумма, количество]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+    
+    def merge(self, values):
+        """Добавляет значения из snapshot() другого процесса"""
+        with self._lock:
+            for key, (counts, total, count) in values.items():
+                state = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+                state[0] = [a + b for a, b in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+    
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока with"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def collect(self):
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        
+        samples = []
+        for key, counts, total, count in items:
+            pairs = self._pairs(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f'{self.name}_bucket', pairs + [('le', _format_value(float(bound)))], cumulative))
+            samples.append((f'{self.name}_bucket', pairs + [('le', '+Inf')], count))
+            samples.append((f'{self.name}_sum', pairs, total))
+            samples.append((f'{self.name}_count', pairs, count))
+        return samples
+
+class MetricsRegistry:
+    """Набор метрик приложения"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def snapshot(self):
+        """Значения накапливаемых метрик по именам (вычисляемые метрики не входят)"""
+        return {metric.name: metric.snapshot() for metric in self._metrics if hasattr(metric, 'merge')}
+    
+    def merge(self, snapshot):
+        """Добавляет значения метрик, накопленные в дочернем процессе"""
+        for metric in self._metrics:
+            if metric.name in snapshot and hasattr(metric, 'merge'):
+                metric.merge(snapshot[metric.name])
+    
+    def render(self):
+        """Текст всех метрик в формате Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            for name, pairs, value in metric.collect():
+                lines.append(f'{name}{_format_labels(pairs)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+REQUEST_DURATION = metrics.register(Histogram(
+    'epub_cutter_http_request_duration_seconds', 'Время обработки HTTP запроса',
+    ('route', 'method', 'status')))
+STAGE_DURATION = metrics.register(Histogram(
+    'epub_cutter_stage_duration_seconds', 'Время этапов загрузки и экспорта книг', ('stage',)))
+STAGE_ERRORS = metrics.register(Counter(
+    'epub_cutter_stage_errors_total', 'Ошибки этапов загрузки и экспорта книг', ('stage',)))
+SOURCE_BYTES = metrics.register(Counter(
+    'epub_cutter_source_bytes_total', 'Прочитано байт исходных EPUB'))
+EXPORT_BYTES = metrics.register(Counter(
+    'epub_cutter_export_bytes_total', 'Размер экспортированных глав в байтах', ('format',)))
+CHAPTERS_PROCESSED = metrics.register(Counter(
+    'epub_cutter_chapters_processed_total', 'Глав, опубликованных на сайтах книг'))
+IMAGES_PROCESSED = metrics.register(Counter(
+    'epub_cutter_images_processed_total', 'Изображений, сохраненных на сайты книг'))
+LINKS_REWRITTEN = metrics.register(Counter(
+    'epub_cutter_links_rewritten_total', 'Внутренних ссылок, переписанных на страницы сайта'))
+MINIFY_BYTES = metrics.register(Counter(
+    'epub_cutter_minify_bytes_total', 'Размер HTML глав до и после минификации', ('state',)))
+
+def timed_stage(stage):
+    """Декоратор: записывает время выполнения функции как этап конвейера"""
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with STAGE_DURATION.time(stage=stage):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorator
+
+class StageTimer:
+    """Суммирует время этапов, повторяющихся для каждой главы, и записывает итог один раз на книгу"""
+    
+    def __init__(self):
+        self.totals = {}
+    
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+    
+    def observe(self):
+        for name, seconds in self.totals.items():
+            STAGE_DURATION.observe(seconds, stage=name)
+
+# Публикация сайтов книг
+BUILD_DIR_PREFIX = '.build-'  # Временные папки сборки сайтов
+OLD_DIR_PREFIX = '.old-'  # Предыдущие версии сайтов на время замены
+SITE_MARKER_NAME = '.epub-cutter-site'  # Файл-отметка сайта, созданного приложением
+TRASH_DIR_NAME = '.trash'  # Сайты удаленных книг до фоновой очистки
+LOCKS_DIR_NAME = '.locks'  # Файлы межпроцессных блокировок публикации
+SITE_LOCK_BUCKETS = 256  # Число блокировок: пути сайтов распределяются по ним хэшем
+
+_site_locks = {}
+_site_locks_guard = threading.Lock()
+
+def book_storage_path(name):
+    """Путь сайта книги относительно books/: ab/cd/<ключ>, где ключ - хэш имени
+    
+    Одно и то же имя (название книги) всегда дает тот же путь, поэтому повторная
+    загрузка заменяет сайт книги. Два уровня по 256 папок не дают каталогам разрастаться.
+    """
+    key = hashlib.sha1(name.encode('utf-8')).hexdigest()[:20]
+    return f"{key[:2]}/{key[2:4]}/{key}"
+
+def is_storage_path(site_path):
+    """Проверяет, что site_path уже в формате ab/cd/<ключ>"""
+    import re
+    return re.fullmatch(r'[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{20}', site_path) is not None
+
+def iter_site_folders(books_folder):
+    """Папки опубликованных сайтов: books/ab/cd/<ключ> и books/<название> до перехода на ключи"""
+    import re
+    for entry in Path(books_folder).iterdir():
+        if not entry.is_dir() or entry.name.startswith('.'):
+            continue
+        if (entry / SITE_MARKER_NAME).exists() or not re.fullmatch(r'[0-9a-f]{2}', entry.name):
+            yield entry
+            continue
+        for shard in entry.iterdir():
+            if shard.is_dir() and re.fullmatch(r'[0-9a-f]{2}', shard.name):
+                yield from (site for site in shard.iterdir() if site.is_dir())
+
+@contextmanager
+def site_lock(target_path, books_folder):
+    """Блокировка публикации сайта по итоговому пути
+    
+    Потоки процесса сериализуются обычной блокировкой, другие процессы
+    (несколько воркеров) - через flock на файле в books/.locks (где доступен fcntl).
+    Путь попадает в одну из SITE_LOCK_BUCKETS блокировок, поэтому ни их файлов, ни
+    записей в памяти не становится больше с числом книг. Вложенно брать
+    блокировки двух сайтов нельзя: они могут оказаться одной блокировкой.
+    """
+    digest = hashlib.sha1(os.path.abspath(target_path).encode('utf-8')).digest()
+    bucket = int.from_bytes(digest[:4], 'big') % SITE_LOCK_BUCKETS
+    with _site_locks_guard:
+        lock = _site_locks.setdefault(bucket, threading.Lock())
+    
+    with lock:
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        
+        locks_dir = Path(books_folder) / LOCKS_DIR_NAME
+        locks_dir.mkdir(exist_ok=True)
+        lock_file = locks_dir / f'{bucket:03d}.lock'
+        with open(lock_file, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def publish_site(build_path, target_path):
+    """Публикует собранный сайт переименованием папки сборки в итоговую
+    
+    Новый сайт появляется одним атомарным rename. Существующий сначала
+    отодвигается в .old-папку и удаляется уже после публикации новой версии.
+    Папка сборки и .old-папки лежат в корне books/.
+    """
+    build_path, target_path = Path(build_path), Path(target_path)
+    books_folder = build_path.parent
+    with site_lock(target_path, books_folder):
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        if target_path.exists():
+            old_path = books_folder / f"{OLD_DIR_PREFIX}{uuid.uuid4().hex}"
+            os.rename(target_path, old_path)
+            os.rename(build_path, target_path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            os.rename(build_path, target_path)
 
 class EPUBProcessor:
     """Класс для обработки EPUB файлов (адаптирован из основного приложения)"""
@@ -80,22 +708,38 @@ class EPUBProcessor:
         self.book_author = ""
         self.chapters = []
         self.images = {}
+        self.source_path = None
+        self.minify_stats = None
+        self.cover_path = None
+        self.toc = []
+        self.load_error = None
+        self._chapters_metadata = None
     
+    @timed_stage('load_epub')
     def load_epub(self, epub_path):
         """Загружает EPUB файл и извлекает главы"""
         try:
             self.chapters.clear()
             self.images.clear()
+            self.source_path = epub_path
+            self.cover_path = None
+            self.toc = []
+            self.load_error = None
+            self._chapters_metadata = None
+            SOURCE_BYTES.inc(os.path.getsize(epub_path))
             
             with zipfile.ZipFile(epub_path, 'r') as epub_zip:
+                # До чтения чего-либо проверяем заявленные размеры файлов архива
+                check_epub_archive(epub_zip)
+                
                 # Чтение структуры EPUB
                 from xml.etree import ElementTree as ET
                 
-                container_xml = epub_zip.read('META-INF/container.xml')
+                container_xml = read_epub_entry(epub_zip, 'META-INF/container.xml')
                 container_root = ET.fromstring(container_xml)
                 
                 opf_path = container_root.find('.//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile').get('full-path')
-                opf_content = epub_zip.read(opf_path)
+                opf_content = read_epub_entry(epub_zip, opf_path)
                 opf_root = ET.fromstring(opf_content)
                 
                 # Извлечение метаданных книги
@@ -110,15 +754,26 @@ class EPUBProcessor:
                         if href:
                             img_path = os.path.join(opf_dir, href).replace('\\', '/')
                             try:
-                                img_data = epub_zip.read(img_path)
+                                img_data = read_epub_entry(epub_zip, img_path)
                                 self.images[img_path] = img_data
+                            except EPUBLimitError:
+                                raise
                             except:
                                 pass
                 
+                self.cover_path = self._find_cover(opf_root, opf_dir)
+                
                 # Загрузка глав
                 spine_items = opf_root.findall('.//{http://www.idpf.org/2007/opf}itemref')
                 manifest_items = {item.get('id'): item for item in opf_root.findall('.//{http://www.idpf.org/2007/opf}item')}
                 
+                # Названия глав берутся из оглавления книги, разбор текста глав - запасной вариант
+                toc_entries = self._read_toc(epub_zip, opf_root, opf_dir, manifest_items)
+                toc_titles = {}
+                for entry in walk_toc(toc_entries):
+                    if entry['file_path'] and entry['title']:
+                        toc_titles.setdefault(entry['file_path'], entry['title'])
+                
                 # Создаем маппинг файлов для будущих ссылок
                 self.file_mapping = {}
                 
@@ -133,26 +788,21 @@ class EPUBProcessor:
                             file_path = os.path.join(opf_dir, href).replace('\\', '/')
                             
                             try:
-                                chapter_content = epub_zip.read(file_path)
+                                chapter_content = read_epub_entry(epub_zip, file_path)
                                 content_str = chapter_content.decode('utf-8')
                                 
-                                # Сначала пытаемся извлечь заголовок из raw текста
+                                # Без пункта оглавления пытаемся извлечь заголовок из raw текста
                                 import re
-                                title_match = re.search(r'<title[^>]*>([^<]+)</title>', content_str, re.IGNORECASE)
-                                title = title_match.group(1).strip() if title_match else f"Глава {i+1}"
+                                import posixpath
+                                title = toc_titles.get(posixpath.normpath(file_path))
+                                if not title:
+                                    title_match = re.search(r'<title[^>]*>([^<]+)</title>', content_str, re.IGNORECASE)
+                                    title = title_match.group(1).strip() if title_match else f"Глава {i+1}"
                                 
                                 # Пытаемся исправить некорректные HTML комментарии для корректного XML
-                                try:
-                                    # Исправляем проблемные комментарии
-                                    fixed_content = re.sub(r'<!--\[endif\]---->', '<!--[endif]-->', content_str)
-                                    fixed_content = re.sub(r'<!--([^>]*?)---->', r'<!--\1-->', fixed_content)
-                                    chapter_root = ET.fromstring(fixed_content.encode('utf-8'))
-                                    
-                                    # Если XML парсится успешно, используем исправленный контент
-                                    chapter_content = fixed_content.encode('utf-8')
-                                except:
-                                    # Если исправление не помогло, используем оригинальный контент
-                                    pass
+                                chapter_content, parsed_root = normalize_chapter_markup(content_str)
+                                if parsed_root is not None:
+                                    chapter_root = parsed_root
                                 
                                 # Дополнительная попытка найти заголовок в заголовках h1-h6, если title пустой
                                 if title == f"Глава {i+1}":
@@ -179,97 +829,422 @@ class EPUBProcessor:
                                 self.chapters.append({
                                     'title': title,
                                     'file_path': file_path,
-                                    'content': chapter_content
+                                    'content': chapter_content,
+                                    'text': extract_plain_text(content_str)
                                 })
                                 
                                 # Сохраняем маппинг для обработки ссылок
                                 self.file_mapping[file_path] = len(self.chapters) - 1
                                 
+                            except EPUBLimitError:
+                                raise
                             except Exception as e:
                                 print(f"Ошибка при чтении главы {file_path}: {e}")
                                 # Даже если возникла критическая ошибка, сохраняем главу
                                 try:
-                                    raw_content = epub_zip.read(file_path)
+                                    raw_content = read_epub_entry(epub_zip, file_path)
                                     title = f"Глава {i+1}"
                                     
                                     self.chapters.append({
                                         'title': title,
                                         'file_path': file_path,
-                                        'content': raw_content
+                                        'content': raw_content,
+                                        'text': extract_plain_text(raw_content)
                                     })
                                     
                                     # Сохраняем маппинг для обработки ссылок
                                     self.file_mapping[file_path] = len(self.chapters) - 1
                                     print(f"Добавлена глава с дефолтным названием: {title}")
+                                except EPUBLimitError:
+                                    raise
                                 except:
                                     print(f"Не удалось загрузить главу {file_path}")
                                     continue
+                
+                # Главы, которых нет в навигации (обложка, примечания), тоже попадают в оглавление
+                self.toc = self._add_unlisted_chapters(self._link_toc(toc_entries))
             
             return True
-            
+        
+        except EPUBLimitError as e:
+            print(f"EPUB отклонен: {e}")
+            self.load_error = str(e)
+            STAGE_ERRORS.inc(stage='epub_limits')
+            return False
         except Exception as e:
             print(f"Ошибка при загрузке EPUB: {e}")
+            STAGE_ERRORS.inc(stage='load_epub')
             return False
     
-    def create_website(self, output_path):
-        """Создает веб-сайт из загруженной книги"""
+    def _read_toc(self, epub_zip, opf_root, opf_dir, manifest_items):
+        """Оглавление из навигационного документа EPUB 3, иначе из NCX EPUB 2
+        
+        Возвращает дерево пунктов со ссылками на файлы внутри EPUB или [],
+        если навигации нет или ее не удалось разобрать.
+        """
+        from xml.etree import ElementTree as ET
+        
+        nav_item = next((item for item in manifest_items.values()
+                         if 'nav' in (item.get('properties') or '').split()), None)
+        spine = opf_root.find('.//{http://www.idpf.org/2007/opf}spine')
+        ncx_item = manifest_items.get(spine.get('toc') if spine is not None else None)
+        if ncx_item is None:
+            ncx_item = next((item for item in manifest_items.values()
+                             if item.get('media-type') == 'application/x-dtbncx+xml'), None)
+        
+        for item, parse in ((nav_item, parse_nav_toc), (ncx_item, parse_ncx_toc)):
+            if item is None or not item.get('href'):
+                continue
+            doc_path = os.path.join(opf_dir, item.get('href')).replace('\\', '/')
+            try:
+                # &nbsp; не определен в XML, но часто встречается в навигации
+                content = read_epub_entry(epub_zip, doc_path).replace(b'&nbsp;', b'&#160;')
+                toc = parse(ET.fromstring(content), os.path.dirname(doc_path))
+            except EPUBLimitError:
+                raise
+            except Exception as e:
+                print(f"Не удалось разобрать оглавление {doc_path}: {e}")
+                continue
+            if toc:
+                return toc
+        return []
+    
+    def _link_toc(self, entries):
+        """Привязывает пункты оглавления к главам: {'title', 'chapter_index', 'fragment', 'children'}
+        
+        Пункты, ведущие на файлы вне spine и без вложенных пунктов, отбрасываются.
+        """
+        import posixpath
+        chapter_indexes = {posixpath.normpath(path): index for path, index in self.file_mapping.items()}
+        
+        nodes = []
+        for entry in entries:
+            children = self._link_toc(entry['children'])
+            index = chapter_indexes.get(entry['file_path'])
+            if index is None and not children:
+                continue
+            nodes.append({
+                'title': entry['title'] or (self.chapters[index]['title'] if index is not None else ''),
+                'chapter_index': index,
+                'fragment': entry['fragment'] if index is not None else None,
+                'children': children
+            })
+        return nodes
+    
+    def _add_unlisted_chapters(self, nodes):
+        """Добавляет главы spine, на которые не ссылается оглавление, пунктами верхнего уровня
+        
+        Каждая такая глава встает перед первым пунктом, ведущим на более позднюю главу,
+        поэтому порядок spine сохраняется, а без навигации получается плоский список глав.
+        """
+        def first_index(node):
+            indexes = [item['chapter_index'] for item in walk_toc([node]) if item['chapter_index'] is not None]
+            return min(indexes) if indexes else None
+        
+        def chapter_node(index):
+            return {'title': self.chapters[index]['title'], 'chapter_index': index, 'fragment': None, 'children': []}
+        
+        listed = {node['chapter_index'] for node in walk_toc(nodes)}
+        unlisted = [index for index in range(len(self.chapters)) if index not in listed]
+        
+        result = []
+        for node in nodes:
+            first = first_index(node)
+            while unlisted and first is not None and unlisted[0] < first:
+                result.append(chapter_node(unlisted.pop(0)))
+            result.append(node)
+        result.extend(chapter_node(index) for index in unlisted)
+        return result
+    
+    def detached(self):
+        """Облегченная копия для передачи из дочернего процесса
+        
+        Без изображений и содержимого глав: метаданные глав вычисляются заранее,
+        текст глав остается для поискового индекса.
+        """
+        import copy
+        light = copy.copy(self)
+        light._chapters_metadata = self.get_chapters_metadata()
+        light.images = {}
+        light.chapters = [
+            {'title': chapter['title'], 'file_path': chapter['file_path'],
+             'text': chapter.get('text') or extract_plain_text(chapter['content'])}
+            for chapter in self.chapters
+        ]
+        return light
+    
+    def to_ir(self):
+        """Промежуточное представление загруженной книги (для book_ir и chapter_ir)
+        
+        Содержимое и текст глав сжаты zlib. Для каждой главы сохраняются пути
+        использованных изображений EPUB и ссылки на другие главы [номер, якорь].
+        """
+        import re
+        import posixpath
+        import zlib
+        
+        chapter_indexes = {posixpath.normpath(path): index for path, index in self.file_mapping.items()}
+        image_paths = {posixpath.normpath(path): path for path in self.images}
+        
+        chapters = []
+        for chapter in self.chapters:
+            content = chapter['content']
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            markup = content.decode('utf-8', errors='replace')
+            base_dir = posixpath.dirname(chapter['file_path'])
+            
+            images = []
+            for src in re.findall(r'<img[^>]*src=["\']([^"\']+)["\']', markup, re.IGNORECASE):
+                path = image_paths.get(resolve_toc_href(base_dir, src)[0])
+                if path and path not in images:
+                    images.append(path)
+            
+            links = []
+            for href in re.findall(r'<a[^>]*href=["\']([^"\']+)["\']', markup, re.IGNORECASE):
+                path, fragment = resolve_toc_href(base_dir, href)
+                link = [chapter_indexes.get(path), fragment]
+                if link[0] is not None and link not in links:
+                    links.append(link)
+            
+            text = chapter.get('text')
+            if text is None:
+                text = extract_plain_text(content)
+            chapters.append({
+                'title': chapter['title'],
+                'file_path': chapter['file_path'],
+                'images': images,
+                'links': links,
+                'body': zlib.compress(content),
+                'text': zlib.compress(text.encode('utf-8'))
+            })
+        
+        return {
+            'version': IR_VERSION,
+            'title': self.book_title,
+            'author': self.book_author,
+            'cover_path': self.cover_path,
+            'images': list(self.images),
+            'toc': self.toc,
+            'chapters': chapters
+        }
+    
+    def load_ir(self, ir, epub_path=None):
+        """Загружает книгу из промежуточного представления без разбора EPUB
+        
+        Главы, содержимое которых не выбиралось из БД, получают content = None.
+        Изображения не загружаются: при необходимости их читает load_images из epub_path.
+        """
+        import zlib
+        
+        self.book_title = ir['title']
+        self.book_author = ir['author']
+        self.source_path = epub_path
+        self.cover_path = ir['cover_path']
+        self.toc = ir['toc']
+        self.images.clear()
+        self.load_error = None
+        self._chapters_metadata = None
+        self.chapters = [
+            {
+                'title': chapter['title'],
+                'file_path': chapter['file_path'],
+                'content': zlib.decompress(chapter['body']) if chapter['body'] is not None else None,
+                'text': zlib.decompress(chapter['text']).decode('utf-8') if chapter['text'] is not None else None,
+                'images': chapter['images'],
+                'links': chapter['links']
+            }
+            for chapter in ir['chapters']
+        ]
+        self.file_mapping = {chapter['file_path']: index for index, chapter in enumerate(self.chapters)}
+        return True
+    
+    def load_images(self, paths):
+        """Читает из исходного EPUB только указанные изображения (после load_ir)"""
+        with zipfile.ZipFile(self.source_path, 'r') as epub_zip:
+            check_epub_archive(epub_zip)
+            for path in paths:
+                if path not in self.images:
+                    self.images[path] = read_epub_entry(epub_zip, path)
+    
+    def load_chapter_contents(self, indexes):
+        """Читает из исходного EPUB содержимое указанных глав, которого нет в памяти (после load_ir)
+        
+        Открываются только файлы этих глав, остальная книга не разбирается.
+        """
+        with zipfile.ZipFile(self.source_path, 'r') as epub_zip:
+            check_epub_archive(epub_zip)
+            for index in indexes:
+                chapter = self.chapters[index]
+                if chapter['content'] is not None:
+                    continue
+                raw_content = read_epub_entry(epub_zip, chapter['file_path'])
+                try:
+                    chapter['content'] = normalize_chapter_markup(raw_content.decode('utf-8'))[0]
+                except UnicodeDecodeError:
+                    chapter['content'] = raw_content
+    
+    def _find_cover(self, opf_root, opf_dir):
+        """Путь к изображению обложки внутри EPUB или None
+        
+        EPUB 3 отмечает обложку свойством cover-image в манифесте,
+        EPUB 2 - элементом <meta name="cover" content="id изображения">.
+        """
+        opf_ns = '{http://www.idpf.org/2007/opf}'
+        items = opf_root.findall(f'.//{opf_ns}item')
+        
+        cover_href = None
+        for item in items:
+            if 'cover-image' in (item.get('properties') or '').split():
+                cover_href = item.get('href')
+                break
+        
+        if cover_href is None:
+            cover_id = next((meta.get('content') for meta in opf_root.iter(f'{opf_ns}meta')
+                             if meta.get('name') == 'cover'), None)
+            cover_href = next((item.get('href') for item in items if item.get('id') == cover_id), None)
+        
+        if not cover_href:
+            return None
+        cover_path = os.path.join(opf_dir, cover_href).replace('\\', '/')
+        return cover_path if cover_path in self.images else None
+    
+    @timed_stage('covers')
+    def create_cover_thumbnails(self, covers_folder):
+        """Создает миниатюры обложки размеров COVER_SIZES в папке covers_folder
+        
+        Файлы называются по хэшу содержимого, поэтому одинаковые обложки не
+        дублируются, а сами файлы можно кэшировать навсегда.
+        Возвращает {размер: путь относительно covers_folder} или None.
+        """
+        if Image is None or not self.cover_path:
+            return None
+        
+        try:
+            with Image.open(io.BytesIO(self.images[self.cover_path])) as original:
+                largest = max(COVER_SIZES.values())
+                original.draft('RGB', largest)  # JPEG декодируется сразу в уменьшенном размере
+                if original.mode in ('RGBA', 'LA', 'P'):
+                    # Прозрачный фон заменяем белым, иначе в JPEG он станет черным
+                    rgba = original.convert('RGBA')
+                    image = Image.new('RGB', rgba.size, 'white')
+                    image.paste(rgba, mask=rgba.split()[-1])
+                else:
+                    image = original.convert('RGB')
+            
+            thumbnails = {}
+            for size_name, box in COVER_SIZES.items():
+                thumbnail = image.copy()
+                thumbnail.thumbnail(box, Image.LANCZOS)
+                buffer = io.BytesIO()
+                thumbnail.save(buffer, 'JPEG', quality=80, optimize=True, progressive=True)
+                data = buffer.getvalue()
+                
+                digest = hashlib.sha256(data).hexdigest()
+                relative_path = f'{digest[:2]}/{digest}.jpg'
+                path = Path(covers_folder) / relative_path
+                if not path.exists():
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    temp_path = path.with_name(f'.{uuid.uuid4().hex}.tmp')
+                    temp_path.write_bytes(data)
+                    os.replace(temp_path, path)
+                thumbnails[size_name] = relative_path
+            return thumbnails
+        except Exception as e:
+            print(f"Ошибка при создании миниатюр обложки: {e}")
+            STAGE_ERRORS.inc(stage='covers')
+            return None
+    
+    def create_website(self, output_path, build_path=None, publish=True):
+        """Создает веб-сайт из загруженной книги
+        
+        build_path - папка сборки внутри output_path (по умолчанию новая .build-папка).
+        При publish = False сайт остается в папке сборки, а возвращается путь,
+        по которому его нужно опубликовать (publish_site).
+        """
+        site_path = None
+        stages = StageTimer()
         try:
             import re
             import html
             
-            # Создание главной папки сайта
-            site_name = re.sub(r'[<>:"/\\|?*]', '', self.book_title)
-            site_path = Path(output_path) / site_name
-            site_path.mkdir(parents=True, exist_ok=True)
+            # Сайт собирается во временной папке рядом с итоговой и публикуется
+            # переименованием, поэтому недособранный сайт никогда не отдается читателям
+            site_name = re.sub(r'[<>:"/\\|?*]', '', self.book_title).strip() or 'book'
+            target_path = Path(output_path) / book_storage_path(site_name)
+            site_path = Path(build_path or Path(output_path) / f"{BUILD_DIR_PREFIX}{uuid.uuid4().hex}")
+            site_path.mkdir(parents=True)
             
             # Создание папки для изображений
             images_path = site_path / "images"
             images_path.mkdir(exist_ok=True)
             
-            # CSS стили (из основного приложения)
-            css_content = self._get_website_css()
-            with open(site_path / "styles.css", 'w', encoding='utf-8') as f:
-                f.write(css_content)
-            
-            # Создание index.html
-            self._create_index_html(site_path)
+            with stages.stage('write_pages'):
+                # CSS стили (из основного приложения)
+                css_content = self._get_website_css()
+                with open(site_path / "styles.css", 'w', encoding='utf-8') as f:
+                    f.write(css_content)
+                
+                # Копия исходного EPUB рядом с сайтом - по ней экспортируются главы
+                if self.source_path and os.path.isfile(self.source_path):
+                    shutil.copyfile(self.source_path, site_path / SOURCE_EPUB_NAME)
+                
+                # Создание index.html
+                self._create_index_html(site_path)
             
             # Создание страниц глав с навигацией
             selected_chapters = [(i, chapter) for i, chapter in enumerate(self.chapters)]
+            page_images = {}
+            minify = app.config['MINIFY_CHAPTERS']
+            bytes_before = bytes_after = 0
             
             for idx, (i, chapter) in enumerate(selected_chapters):
-                chapter_num = i + 1
-                safe_title = re.sub(r'[<>:"/\\|?*]', '', chapter['title'])
-                filename = f"chapter_{chapter_num:02d}_{safe_title}.html"
+                filename = chapter_filename(i, chapter['title'])
                 filepath = site_path / filename
                 
                 # Обработка содержимого главы
                 content = chapter['content'].decode('utf-8')
                 content = content.replace('xmlns="http://www.w3.org/1999/xhtml"', '')
                 
+                # Очистка от мусора Word и лишних пробелов (текст главы не должен измениться)
+                if minify:
+                    with stages.stage('minify'):
+                        minified = minify_chapter_html(content)
+                        if visible_text(minified) != visible_text(content):
+                            print(f"Минификация изменила текст главы {chapter['title']}, глава оставлена без изменений")
+                            minified = content
+                    bytes_before += len(content.encode('utf-8'))
+                    bytes_after += len(minified.encode('utf-8'))
+                    content = minified
+                
                 # Обработка изображений
-                content = self._process_images_for_website(content, images_path)
+                with stages.stage('images'):
+                    content = self._process_images_for_website(content, images_path)
+                page_images[filename] = sorted(set(re.findall(r'src="(images/[^"]+)"', content)))
                 
                 # Обработка внутренних ссылок
-                content = self._process_internal_links(content, selected_chapters, idx)
+                with stages.stage('links'):
+                    content = self._process_internal_links(content, selected_chapters, idx)
+                
+                # Идентификаторы блоков для привязки заметок
+                with stages.stage('block_ids'):
+                    content = self._add_block_ids(content)
                 
                 # Создание навигации
                 prev_link = ""
                 next_link = ""
+                next_rel = ""
                 
                 if idx > 0:
-                    prev_chapter = selected_chapters[idx-1][1]
-                    prev_safe_title = re.sub(r'[<>:"/\\|?*]', '', prev_chapter['title'])
-                    prev_num = selected_chapters[idx-1][0] + 1
-                    prev_filename = f"chapter_{prev_num:02d}_{prev_safe_title}.html"
+                    prev_index, prev_chapter = selected_chapters[idx-1]
+                    prev_filename = chapter_filename(prev_index, prev_chapter['title'])
                     prev_link = f'<a href="{prev_filename}" class="nav-button">← Предыдущая</a>'
                 
                 if idx < len(selected_chapters) - 1:
-                    next_chapter = selected_chapters[idx+1][1]
-                    next_safe_title = re.sub(r'[<>:"/\\|?*]', '', next_chapter['title'])
-                    next_num = selected_chapters[idx+1][0] + 1
-                    next_filename = f"chapter_{next_num:02d}_{next_safe_title}.html"
+                    next_index, next_chapter = selected_chapters[idx+1]
+                    next_filename = chapter_filename(next_index, next_chapter['title'])
                     next_link = f'<a href="{next_filename}" class="nav-button">Следующая →</a>'
+                    next_rel = f'<link rel="next" href="{next_filename}">'
                 
                 # Создание полного HTML документа главы
                 chapter_html = f"""<!DOCTYPE html>
@@ -279,6 +1254,7 @@ class EPUBProcessor:
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>{html.escape(chapter['title'])} - {html.escape(self.book_title)}</title>
     <link rel="stylesheet" href="styles.css">
+    {next_rel}
 </head>
 <body class="theme-vintage">
     <!-- Переключатель тем -->
@@ -309,7 +1285,7 @@ class EPUBProcessor:
         </div>
     </div>
     
-    <div class="chapter-content" data-chapter-title="{html.escape(chapter['title'])}">
+    <div class="chapter-content" data-chapter-title="{html.escape(chapter['title'])}" data-chapter-index="{i}">
         {content}
     </div>
     
@@ -320,6 +1296,7 @@ class EPUBProcessor:
     </div>
     
     <script src="/static/js/notes.js"></script>
+    <script src="/static/js/offline.js"></script>
     <script>
         // Функция переключения тем
         function setTheme(theme) {{
@@ -347,9 +1324,10 @@ class EPUBProcessor:
         
         // Функция скачивания главы
         function downloadChapter(format) {{
-            const pathParts = window.location.pathname.split('/');
-            if (pathParts[1] === 'book' && pathParts[2]) {{
-                const bookPath = pathParts[2];
+            // Путь к папке книги (site_path, например ab/cd/<ключ>) - часть URL между /book/ и именем страницы
+            const match = window.location.pathname.match(/^\\/book\\/(.+)\\/[^\\/]*$/);
+            if (match) {{
+                const bookPath = decodeURIComponent(match[1]);
                 
                 // Сначала получаем book_id
                 fetch(`/api/book-info?path=${{encodeURIComponent(bookPath)}}`)
@@ -383,9 +1361,9 @@ class EPUBProcessor:
             loadSavedTheme();
             
             // Получаем book_id из пути URL
-            const pathParts = window.location.pathname.split('/');
-            if (pathParts[1] === 'book' && pathParts[2]) {{
-                const bookPath = pathParts[2];
+            const match = window.location.pathname.match(/^\\/book\\/(.+)\\/[^\\/]*$/);
+            if (match) {{
+                const bookPath = decodeURIComponent(match[1]);
                 fetch(`/api/book-info?path=${{encodeURIComponent(bookPath)}}`)
                     .then(response => response.json())
                     .then(data => {{
@@ -401,13 +1379,35 @@ class EPUBProcessor:
 </body>
 </html>"""
                 
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    f.write(chapter_html)
+                with stages.stage('write_pages'):
+                    with open(filepath, 'w', encoding='utf-8') as f:
+                        f.write(chapter_html)
+            
+            # Service worker для предзагрузки глав и офлайн-чтения
+            with stages.stage('write_pages'):
+                self._create_service_worker(site_path, page_images)
+            
+            # Отметка о том, что папка создана приложением (см. cleanup_site_builds)
+            (site_path / SITE_MARKER_NAME).touch()
+            
+            if publish:
+                with stages.stage('publish'):
+                    publish_site(site_path, target_path)
             
-            return str(site_path)
+            stages.observe()
+            CHAPTERS_PROCESSED.inc(len(selected_chapters))
+            if minify:
+                self.minify_stats = {'bytes_before': bytes_before, 'bytes_after': bytes_after}
+                MINIFY_BYTES.inc(bytes_before, state='before')
+                MINIFY_BYTES.inc(bytes_after, state='after')
+                print(f"Минификация глав: {bytes_before} -> {bytes_after} байт")
+            return str(target_path)
             
         except Exception as e:
             print(f"Ошибка при создании сайта: {e}")
+            STAGE_ERRORS.inc(stage='create_website')
+            if site_path is not None and site_path.exists():
+                shutil.rmtree(site_path, ignore_errors=True)
             return None
     
     def _create_index_html(self, site_path):
@@ -420,6 +1420,12 @@ class EPUBProcessor:
         # Создаем словарь соответствий для ссылок в оглавлении
         self._create_chapter_mapping(selected_chapters)
         
+        # Первая глава предзагружается, пока читатель смотрит оглавление
+        next_rel = ""
+        if selected_chapters:
+            first_index, first_chapter = selected_chapters[0]
+            next_rel = f'<link rel="next" href="{chapter_filename(first_index, first_chapter["title"])}">'
+        
         html_content = f"""<!DOCTYPE html>
 <html lang="ru" class="theme-vintage">
 <head>
@@ -427,6 +1433,7 @@ class EPUBProcessor:
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>{self.book_title}</title>
     <link rel="stylesheet" href="styles.css">
+    {next_rel}
 </head>
 <body class="theme-vintage">
     <!-- Переключатель тем -->
@@ -448,18 +1455,7 @@ class EPUBProcessor:
         <ul>
 """
         
-        for i, (chapter_idx, chapter) in enumerate(selected_chapters):
-            chapter_num = chapter_idx + 1
-            safe_title = re.sub(r'[<>:"/\\|?*]', '', chapter['title'])
-            filename = f"chapter_{chapter_num:02d}_{safe_title}.html"
-            
-            html_content += f"""            <li>
-                <a href="{filename}">
-                    <span>{html.escape(chapter['title'])}</span>
-                    <span class="chapter-number">{chapter_num}</span>
-                </a>
-            </li>
-"""
+        html_content += self._render_toc_items(self.toc, set(), 3)
         
         html_content += f"""        </ul>
     </div>
@@ -468,6 +1464,12 @@ class EPUBProcessor:
         <p>Эта книга содержит {len(selected_chapters)} глав. Выберите главу из оглавления выше для чтения.</p>
     </div>
     
+    <div class="download-section" id="offlineSection" hidden>
+        <button type="button" id="offlineButton" class="download-btn epub-btn">📥 Сохранить для чтения офлайн</button>
+        <p class="offline-status" id="offlineStatus"></p>
+    </div>
+    
+    <script src="/static/js/offline.js"></script>
     <script>
         // Функция переключения тем
         function setTheme(theme) {{
@@ -495,33 +1497,11 @@ class EPUBProcessor:
         
         // Функция скачивания главы по индексу
         function downloadChapterByIndex(chapterIndex, format) {{
-            // Извлекаем название папки книги из текущего URL
-            // Это и есть site_path в базе данных
-            let bookPath = '';
-            
+            // Путь к папке книги - часть URL между /book/ и именем страницы
+            // Это и есть site_path в базе данных (например ab/cd/<ключ>)
             const currentPath = window.location.pathname;
-            const pathParts = currentPath.split('/');
-            
-            // Ищем папку с книгой в пути
-            for (let i = 0; i < pathParts.length; i++) {{
-                if (pathParts[i] === 'books' && pathParts[i + 1]) {{
-                    // Нашли папку books, следующий элемент - название книги
-                    bookPath = decodeURIComponent(pathParts[i + 1]);
-                    break;
-                }} else if (pathParts[i] === 'book' && pathParts[i + 1]) {{
-                    // URL через роут /book/
-                    bookPath = decodeURIComponent(pathParts[i + 1]);
-                    break;
-                }}
-            }}
-            
-            // Если не найдено, попробуем извлечь из последней части пути до index.html
-            if (!bookPath) {{
-                const match = currentPath.match(/\\/([^\\/]+)\\/[^\\/]*$/);
-                if (match) {{
-                    bookPath = decodeURIComponent(match[1]);
-                }}
-            }}
+            const match = currentPath.match(/^\\/book\\/(.+)\\/[^\\/]*$/);
+            const bookPath = match ? decodeURIComponent(match[1]) : '';
             
             console.log('Текущий URL:', currentPath);
             console.log('Используемый путь к книге:', bookPath);
@@ -558,15 +1538,17 @@ class EPUBProcessor:
             // Загружаем сохраненную тему
             loadSavedTheme();
             
-            const chapters = document.querySelectorAll('.toc li');
-            chapters.forEach((li, index) => {{
+            // Кнопки есть только у первого пункта оглавления каждой главы
+            const chapters = document.querySelectorAll('.toc [data-chapter-index]');
+            chapters.forEach(entry => {{
+                const index = parseInt(entry.dataset.chapterIndex, 10);
                 const downloadDiv = document.createElement('div');
                 downloadDiv.className = 'chapter-download-buttons';
                 downloadDiv.innerHTML = `
                     <button onclick="downloadChapterByIndex(${{index}}, 'epub')" class="mini-download-btn epub-btn" title="Скачать в EPUB">📖</button>
                     <button onclick="downloadChapterByIndex(${{index}}, 'docx')" class="mini-download-btn docx-btn" title="Скачать в DOCX">📄</button>
                 `;
-                li.appendChild(downloadDiv);
+                entry.appendChild(downloadDiv);
             }});
         }});
     </script>
@@ -576,6 +1558,99 @@ class EPUBProcessor:
         with open(site_path / "index.html", 'w', encoding='utf-8') as f:
             f.write(html_content)
     
+    def _render_toc_items(self, nodes, listed, depth):
+        """HTML пунктов оглавления со вложенными списками
+        
+        listed - главы, уже показанные выше: номер главы и data-chapter-index
+        (по нему добавляются кнопки скачивания) получает только первый пункт главы.
+        """
+        import html
+        indent = ' ' * (depth * 4)
+        items = ''
+        for node in nodes:
+            index = node['chapter_index']
+            label = f'<span>{html.escape(node["title"])}</span>'
+            attributes = ''
+            if index is not None:
+                href = chapter_filename(index, self.chapters[index]['title'])
+                if node['fragment']:
+                    href += '#' + node['fragment']
+                number = ''
+                if index not in listed:
+                    listed.add(index)
+                    attributes = f' data-chapter-index="{index}"'
+                    number = f'<span class="chapter-number">{index + 1}</span>'
+                label = f'<a href="{html.escape(href)}">{label}{number}</a>'
+            
+            items += f'{indent}<li>\n{indent}    <div class="toc-entry"{attributes}>{label}</div>\n'
+            if node['children']:
+                items += f'{indent}    <ul>\n'
+                items += self._render_toc_items(node['children'], listed, depth + 2)
+                items += f'{indent}    </ul>\n'
+            items += f'{indent}</li>\n'
+        return items
+    
+    def _create_service_worker(self, site_path, page_images):
+        """Создает sw.js сайта: шаблон service worker с манифестом файлов книги
+        
+        Версия кэша - хэш всех файлов сайта, поэтому любое изменение книги
+        дает новый service worker, и браузер не показывает устаревшие страницы.
+        """
+        content_hash = hashlib.sha256()
+        for path in sorted(site_path.rglob('*')):
+            if path.is_file() and path.name != SOURCE_EPUB_NAME:
+                content_hash.update(path.relative_to(site_path).as_posix().encode('utf-8'))
+                content_hash.update(path.read_bytes())
+        
+        shell = ['index.html', 'styles.css']
+        pages = {'index.html': []}
+        pages.update(page_images)
+        
+        files = set(shell) | set(pages)
+        for images in pages.values():
+            files.update(images)
+        total_bytes = sum((site_path / name).stat().st_size for name in files if (site_path / name).is_file())
+        
+        book = {
+            'version': content_hash.hexdigest()[:16],
+            'shell': shell,
+            'pages': pages,
+            'bytes': total_bytes,
+            'offline': total_bytes <= app.config['OFFLINE_BOOK_MAX_BYTES']
+        }
+        with open(SERVICE_WORKER_TEMPLATE, encoding='utf-8') as f:
+            template = f.read()
+        with open(site_path / SERVICE_WORKER_NAME, 'w', encoding='utf-8') as f:
+            f.write(f"const BOOK = {json.dumps(book, ensure_ascii=False)};\n\n{template}")
+    
+    def get_chapters_metadata(self):
+        """Возвращает метаданные глав для таблицы chapters"""
+        import re
+        
+        if self._chapters_metadata is not None:
+            return self._chapters_metadata
+        
+        metadata = []
+        for index, chapter in enumerate(self.chapters):
+            content = chapter['content']
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            text = chapter.get('text')
+            if text is None:
+                text = extract_plain_text(content)
+            
+            metadata.append({
+                'chapter_index': index,
+                'title': chapter['title'],
+                'source_href': chapter['file_path'],
+                'filename': chapter_filename(index, chapter['title']),
+                'byte_size': len(content),
+                'word_count': len(text.split()),
+                'image_count': len(re.findall(rb'<img[\s>/]', content, re.IGNORECASE)),
+                'content_hash': hashlib.sha256(content).hexdigest()
+            })
+        return metadata
+    
     def _process_images_for_website(self, content, images_path):
         """Обрабатывает изображения для веб-сайта"""
         import re
@@ -598,6 +1673,8 @@ class EPUBProcessor:
                     with open(img_filepath, 'wb') as f:
                         f.write(img_data)
                     
+                    IMAGES_PROCESSED.inc()
+                    
                     # Заменяем путь в HTML
                     relative_path = f"images/{img_filename}"
                     new_img_tag = img_tag.replace(f'src="{src}"', f'src="{relative_path}"')
@@ -608,6 +1685,26 @@ class EPUBProcessor:
         
         return re.sub(img_pattern, replace_img, content)
     
+    def _add_block_ids(self, content):
+        """Добавляет блочным элементам главы атрибут data-block с порядковым номером
+        
+        Заметки хранят номер блока и смещения символов внутри него, поэтому
+        выделение восстанавливается без поиска текста по всей главе.
+        """
+        import re
+        
+        counter = [0]
+        
+        def add_id(match):
+            attributes = match.group(2) or ''
+            if 'data-block=' in attributes:
+                return match.group(0)
+            counter[0] += 1
+            return f'<{match.group(1)} data-block="b{counter[0]}"{attributes}>'
+        
+        block_pattern = r'<(p|h[1-6]|li|blockquote|pre|dd|dt|td|th|figcaption)(\s[^>]*)?>'
+        return re.sub(block_pattern, add_id, content, flags=re.IGNORECASE)
+    
     def _process_internal_links(self, content, selected_chapters, current_idx):
         """Обрабатывает внутренние ссылки между главами"""
         import re
@@ -621,9 +1718,7 @@ class EPUBProcessor:
             original_filename = original_path.split('/')[-1]
             
             # Создаем имя нового файла
-            chapter_num = i + 1
-            safe_title = re.sub(r'[<>:"/\\|?*]', '', chapter['title'])
-            new_filename = f"chapter_{chapter_num:02d}_{safe_title}.html"
+            new_filename = chapter_filename(i, chapter['title'])
             
             # Добавляем различные варианты ссылок
             link_mapping[original_filename] = new_filename
@@ -685,6 +1780,7 @@ class EPUBProcessor:
                 # Отладочный вывод (можно убрать в продакшене)
                 if file_part != new_filename:
                     print(f"Заменяем ссылку: {href_value} -> {new_href}")
+                LINKS_REWRITTEN.inc()
                 return full_match.replace(href_value, new_href)
             
             return full_match
@@ -1133,9 +2229,7 @@ img {
             original_path = chapter['file_path']
             original_filename = original_path.split('/')[-1]
             
-            chapter_num = i + 1
-            safe_title = re.sub(r'[<>:"/\\|?*]', '', chapter['title'])
-            new_filename = f"chapter_{chapter_num:02d}_{safe_title}.html"
+            new_filename = chapter_filename(i, chapter['title'])
             
             # Различные варианты ссылок
             self.chapter_mapping[original_filename] = new_filename
@@ -1258,6 +2352,13 @@ img {
         .toc li {
             padding: 8px 0;
             border-bottom: 1px solid var(--border-color);
+        }
+        
+        .toc ul ul {
+            margin: 8px 0 -8px 20px;
+        }
+        
+        .toc-entry {
             position: relative;
         }
         
@@ -1334,6 +2435,13 @@ img {
             font-weight: bold;
         }
         
+        .note-highlight {
+            background-color: var(--highlight-bg);
+            color: inherit;
+            border-bottom: 2px solid var(--accent-color);
+            cursor: help;
+        }
+        
         .chapter-content {
             margin-top: 30px;
             padding: 20px;
@@ -1434,6 +2542,16 @@ img {
             box-shadow: 0 2px 4px var(--shadow);
         }
         
+        .offline-status {
+            margin-top: 10px;
+            color: var(--secondary-color);
+            font-size: 0.9rem;
+        }
+        
+        .offline-status:empty {
+            display: none;
+        }
+        
         .download-section h3 {
             color: var(--heading-color);
             margin-bottom: 15px;
@@ -1534,26 +2652,172 @@ img {
         }
         """
 
-# Инициализация базы данных
-def init_db():
-    """Инициализирует базу данных для хранения информации о книгах"""
-    conn = sqlite3.connect('books.db')
-    cursor = conn.cursor()
+# Доступ к базе данных
+class SQLitePool:
+    """Пул соединений SQLite в режиме WAL с настроенными PRAGMA
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS books (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            author TEXT NOT NULL,
-            original_filename TEXT NOT NULL,
-            site_path TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            chapters_count INTEGER DEFAULT 0
-        )
-    ''')
+    Соединения переиспользуются между запросами и потоками, поэтому
+    открытые транзакции откатываются при возврате соединения в пул.
+    """
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notes (
+    def __init__(self, database, size=8, busy_timeout=5000, cache_size=-16000, mmap_size=0):
+        self.database = database
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+    
+    def _connect(self):
+        """Открывает новое соединение и применяет настройки"""
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout / 1000, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # В режиме WAL безопасно и без fsync на каждый коммит
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute('PRAGMA foreign_keys=ON')  # Нужно для ON DELETE CASCADE
+        return conn
+    
+    def acquire(self):
+        """Берет соединение из пула, при необходимости открывает новое"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        try:
+            return self._idle.get(timeout=self.busy_timeout / 1000)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Нет свободных соединений с базой данных')
+    
+    def release(self, conn):
+        """Возвращает соединение в пул, откатывая незавершенную транзакцию"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+    
+    @contextmanager
+    def connection(self):
+        """Соединение на время блока with (для кода вне запросов Flask)"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+    
+    def close_all(self):
+        """Закрывает все свободные соединения"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Возвращает общий пул соединений, создавая его при первом обращении"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                pool = SQLitePool(
+                    app.config['DATABASE'],
+                    size=app.config['DB_POOL_SIZE'],
+                    busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+                    cache_size=app.config['DB_CACHE_SIZE'],
+                    mmap_size=app.config['DB_MMAP_SIZE']
+                )
+                # Схема приводится к актуальной версии до первого запроса
+                with pool.connection() as conn:
+                    migrate_db(conn)
+                _db_pool = pool
+    return _db_pool
+
+def get_db():
+    """Соединение с БД для текущего запроса, возвращается в пул по его окончании"""
+    if 'db' not in g:
+        g.db = get_db_pool().acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    """Возвращает соединение запроса в пул"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_db_pool().release(conn)
+
+def release_db_early():
+    """Досрочно возвращает соединение запроса в пул (перед долгой работой без БД)
+    
+    Следующий get_db() в этом же запросе снова возьмет соединение из пула.
+    """
+    release_db(None)
+
+# Миграции схемы базы данных
+def _migrate_unique_site_path(conn):
+    """Объединяет дубликаты site_path и создает уникальный индекс
+    
+    Дубликаты появлялись при повторной загрузке книги с тем же названием:
+    обе записи указывали на одну папку сайта. Оставляем последнюю запись,
+    заметки старых записей переносим на нее.
+    """
+    duplicates = conn.execute('''
+        SELECT site_path, MAX(id) FROM books GROUP BY site_path HAVING COUNT(*) > 1
+    ''').fetchall()
+    
+    for site_path, keep_id in duplicates:
+        conn.execute('''
+            UPDATE notes SET book_id = ?
+            WHERE book_id IN (SELECT id FROM books WHERE site_path = ? AND id != ?)
+        ''', (keep_id, site_path, keep_id))
+        conn.execute('DELETE FROM books WHERE site_path = ? AND id != ?', (site_path, keep_id))
+    
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_books_site_path ON books (site_path)')
+
+# Список миграций: (версия, описание, SQL команды или функция от соединения).
+# Версия схемы хранится в PRAGMA user_version, новые миграции добавляются в конец.
+MIGRATIONS = [
+    (1, 'Таблицы books и notes', [
+        '''
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            original_filename TEXT NOT NULL,
+            site_path TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            chapters_count INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS notes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             book_id INTEGER NOT NULL,
             chapter_title TEXT NOT NULL,
@@ -1562,11 +2826,1153 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (book_id) REFERENCES books (id) ON DELETE CASCADE
         )
-    ''')
+        ''',
+    ]),
+    (2, 'Уникальный индекс books.site_path', _migrate_unique_site_path),
+    (3, 'Индекс заметок по книге и дате', [
+        'CREATE INDEX IF NOT EXISTS idx_notes_book_created ON notes (book_id, created_at)',
+    ]),
+    (4, 'Индекс каталога по дате добавления', [
+        'CREATE INDEX IF NOT EXISTS idx_books_created ON books (created_at, id)',
+    ]),
+    (5, 'Полнотекстовый индекс глав', [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS chapters_fts USING fts5(
+            title,
+            body,
+            book_id UNINDEXED,
+            chapter_index UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        ''',
+    ]),
+    (6, 'Полнотекстовый индекс заметок с триггерами синхронизации', [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            selected_text,
+            note_text,
+            content = 'notes',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, selected_text, note_text)
+            VALUES (new.id, new.selected_text, new.note_text);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, selected_text, note_text)
+            VALUES ('delete', old.id, old.selected_text, old.note_text);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF selected_text, note_text ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, selected_text, note_text)
+            VALUES ('delete', old.id, old.selected_text, old.note_text);
+            INSERT INTO notes_fts (rowid, selected_text, note_text)
+            VALUES (new.id, new.selected_text, new.note_text);
+        END
+        ''',
+        # Индексируем заметки, созданные до миграции
+        "INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')",
+    ]),
+    (7, 'Таблица метаданных глав', [
+        '''
+        CREATE TABLE IF NOT EXISTS chapters (
+            book_id INTEGER NOT NULL,
+            chapter_index INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            source_href TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            byte_size INTEGER NOT NULL DEFAULT 0,
+            word_count INTEGER NOT NULL DEFAULT 0,
+            image_count INTEGER NOT NULL DEFAULT 0,
+            content_hash TEXT NOT NULL,
+            PRIMARY KEY (book_id, chapter_index),
+            FOREIGN KEY (book_id) REFERENCES books (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (8, 'Позиционные якоря заметок', [
+        'ALTER TABLE notes ADD COLUMN chapter_index INTEGER',
+        'ALTER TABLE notes ADD COLUMN block_id TEXT',
+        'ALTER TABLE notes ADD COLUMN start_offset INTEGER',
+        'ALTER TABLE notes ADD COLUMN end_offset INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_notes_book_chapter ON notes (book_id, chapter_index)',
+    ]),
+    (9, 'Миниатюры обложек книг', [
+        'ALTER TABLE books ADD COLUMN cover_small TEXT',
+        'ALTER TABLE books ADD COLUMN cover_large TEXT',
+    ]),
+    (10, 'Поколение библиотеки для кэша каталога', [
+        '''
+        CREATE TABLE library_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        ''',
+        "INSERT INTO library_meta (key, value) VALUES ('generation', 0)",
+        '''
+        CREATE TRIGGER books_generation_insert AFTER INSERT ON books BEGIN
+            UPDATE library_meta SET value = value + 1 WHERE key = 'generation';
+        END
+        ''',
+        '''
+        CREATE TRIGGER books_generation_update AFTER UPDATE ON books BEGIN
+            UPDATE library_meta SET value = value + 1 WHERE key = 'generation';
+        END
+        ''',
+        '''
+        CREATE TRIGGER books_generation_delete AFTER DELETE ON books BEGIN
+            UPDATE library_meta SET value = value + 1 WHERE key = 'generation';
+        END
+        ''',
+    ]),
+    (11, 'Отметка об удалении книг', [
+        'ALTER TABLE books ADD COLUMN deleted_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS idx_books_deleted ON books (deleted_at) WHERE deleted_at IS NOT NULL',
+    ]),
+    (12, 'Оглавление книги', [
+        'ALTER TABLE books ADD COLUMN toc TEXT',
+    ]),
+    (13, 'Промежуточное представление книг', [
+        '''
+        CREATE TABLE IF NOT EXISTS book_ir (
+            book_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            cover_path TEXT,
+            images TEXT NOT NULL,
+            toc TEXT NOT NULL,
+            FOREIGN KEY (book_id) REFERENCES books (id) ON DELETE CASCADE
+        )
+        ''',
+        # Сжатые body и text стоят последними: выборка списка глав
+        # не читает их страницы переполнения
+        '''
+        CREATE TABLE IF NOT EXISTS chapter_ir (
+            book_id INTEGER NOT NULL,
+            chapter_index INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            images TEXT NOT NULL,
+            links TEXT NOT NULL,
+            body BLOB NOT NULL,
+            text BLOB NOT NULL,
+            PRIMARY KEY (book_id, chapter_index),
+            FOREIGN KEY (book_id) REFERENCES books (id) ON DELETE CASCADE
+        )
+        ''',
+    ]),
+]
+
+def migrate_db(conn):
+    """Применяет к базе недостающие миграции, каждую в отдельной транзакции"""
+    for version, description, steps in MIGRATIONS:
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+            continue
+        
+        # BEGIN IMMEDIATE сразу берет блокировку записи: параллельно
+        # запущенный процесс дождется ее и увидит уже обновленную версию
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            
+            if callable(steps):
+                steps(conn)
+            else:
+                for sql in steps:
+                    conn.execute(sql)
+            
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        print(f"Применена миграция БД {version}: {description}")
+
+# Инициализация базы данных
+def init_db():
+    """Инициализирует базу данных: применяет недостающие миграции схемы"""
+    with get_db_pool().connection() as conn:
+        migrate_db(conn)
+
+# Метаданные глав
+CHAPTER_COLUMNS = 'chapter_index, title, source_href, filename, byte_size, word_count, image_count, content_hash'
+
+def save_book_chapters(cursor, book_id, processor):
+    """Сохраняет метаданные глав книги (вызывается в транзакции загрузки)"""
+    cursor.execute('DELETE FROM chapters WHERE book_id = ?', (book_id,))
+    cursor.executemany(f'''
+        INSERT INTO chapters (book_id, {CHAPTER_COLUMNS})
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (book_id, meta['chapter_index'], meta['title'], meta['source_href'], meta['filename'],
+         meta['byte_size'], meta['word_count'], meta['image_count'], meta['content_hash'])
+        for meta in processor.get_chapters_metadata()
+    ])
+
+def save_book_toc(cursor, book_id, processor):
+    """Сохраняет дерево оглавления книги в JSON (вызывается в транзакции загрузки)"""
+    cursor.execute('UPDATE books SET toc = ? WHERE id = ?',
+                   (json.dumps(processor.toc, ensure_ascii=False), book_id))
+
+def toc_to_dict(nodes, site_path, filenames):
+    """Дерево оглавления для API со ссылками на страницы сайта книги"""
+    from urllib.parse import quote
+    result = []
+    for node in nodes:
+        index = node['chapter_index']
+        url = None
+        if index in filenames:
+            url = quote(f"/book/{site_path}/{filenames[index]}")
+            if node['fragment']:
+                url += '#' + quote(node['fragment'])
+        result.append({
+            'title': node['title'],
+            'chapter_index': index,
+            'url': url,
+            'children': toc_to_dict(node['children'], site_path, filenames)
+        })
+    return result
+
+# Промежуточное представление книг: результат load_epub, сохраненный в БД один раз,
+# чтобы экспорт и переиндексация не разбирали исходный EPUB заново.
+# Версию нужно увеличивать при любом изменении разбора EPUB: записи прежних
+# версий игнорируются и пересоздаются по исходному EPUB.
+IR_VERSION = 2
+
+def save_book_ir(cursor, book_id, ir):
+    """Сохраняет промежуточное представление книги (результат EPUBProcessor.to_ir)"""
+    cursor.execute('DELETE FROM chapter_ir WHERE book_id = ?', (book_id,))
+    cursor.execute('''
+        INSERT OR REPLACE INTO book_ir (book_id, version, title, author, cover_path, images, toc)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (book_id, ir['version'], ir['title'], ir['author'], ir['cover_path'],
+          json.dumps(ir['images'], ensure_ascii=False), json.dumps(ir['toc'], ensure_ascii=False)))
+    cursor.executemany('''
+        INSERT INTO chapter_ir (book_id, chapter_index, title, file_path, images, links, body, text)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (book_id, index, chapter['title'], chapter['file_path'],
+         json.dumps(chapter['images'], ensure_ascii=False), json.dumps(chapter['links'], ensure_ascii=False),
+         chapter['body'], chapter['text'])
+        for index, chapter in enumerate(ir['chapters'])
+    ])
+
+def load_book_ir(cursor, book_id, chapter_indexes=None):
+    """Промежуточное представление книги или None, если его нет или оно другой версии
     
-    conn.commit()
+    Содержимое и текст выбираются только для глав chapter_indexes (None - для всех),
+    у остальных глав 'body' и 'text' равны None. Данные остаются сжатыми.
+    """
+    cursor.execute('SELECT version, title, author, cover_path, images, toc FROM book_ir WHERE book_id = ?',
+                   (book_id,))
+    row = cursor.fetchone()
+    if row is None or row[0] != IR_VERSION:
+        return None
+    
+    version, title, author, cover_path, images, toc = row
+    cursor.execute('''
+        SELECT chapter_index, title, file_path, images, links FROM chapter_ir
+        WHERE book_id = ? ORDER BY chapter_index
+    ''', (book_id,))
+    chapters = [
+        {'title': chapter_title, 'file_path': file_path, 'images': json.loads(chapter_images),
+         'links': json.loads(links), 'body': None, 'text': None}
+        for _, chapter_title, file_path, chapter_images, links in cursor.fetchall()
+    ]
+    
+    if chapter_indexes is None:
+        cursor.execute('SELECT chapter_index, body, text FROM chapter_ir WHERE book_id = ?', (book_id,))
+    else:
+        wanted = sorted({index for index in chapter_indexes if 0 <= index < len(chapters)})
+        placeholders = ','.join('?' * len(wanted))
+        cursor.execute(f'''
+            SELECT chapter_index, body, text FROM chapter_ir
+            WHERE book_id = ? AND chapter_index IN ({placeholders})
+        ''', (book_id, *wanted))
+    for index, body, text in cursor.fetchall():
+        chapters[index].update(body=body, text=text)
+    
+    return {
+        'version': version,
+        'title': title,
+        'author': author,
+        'cover_path': cover_path,
+        'images': json.loads(images),
+        'toc': json.loads(toc),
+        'chapters': chapters
+    }
+
+def is_book_available(cursor, book_id):
+    """Есть ли книга в библиотеке (книги в корзине не считаются)"""
+    cursor.execute('SELECT 1 FROM books WHERE id = ? AND deleted_at IS NULL', (book_id,))
+    return cursor.fetchone() is not None
+
+def load_chapters_outline(cursor, book_id):
+    """Промежуточное представление без содержимого глав из таблиц books и chapters или None
+    
+    Для книг без book_ir: главы и их файлы в EPUB известны из chapters,
+    поэтому для экспорта из EPUB читаются только нужные главы (load_chapter_contents).
+    """
+    cursor.execute('SELECT title, author, toc FROM books WHERE id = ?', (book_id,))
+    book = cursor.fetchone()
+    cursor.execute('SELECT title, source_href FROM chapters WHERE book_id = ? ORDER BY chapter_index', (book_id,))
+    chapters = cursor.fetchall()
+    if book is None or not chapters:
+        return None
+    
+    title, author, toc = book
+    return {
+        'version': None,
+        'title': title,
+        'author': author,
+        'cover_path': None,
+        'images': [],
+        'toc': json.loads(toc) if toc else [],
+        'chapters': [
+            {'title': chapter_title, 'file_path': source_href, 'images': [], 'links': [], 'body': None, 'text': None}
+            for chapter_title, source_href in chapters
+        ]
+    }
+
+def note_anchor(data):
+    """Позиционный якорь заметки из данных запроса: (chapter_index, block_id, start_offset, end_offset)
+    
+    Неполный или некорректный якорь не мешает сохранить заметку:
+    такие поля записываются как NULL.
+    """
+    # bool - подкласс int, а True в JSON не номер главы
+    chapter_index = data.get('chapter_index')
+    if type(chapter_index) is not int or chapter_index < 0:
+        chapter_index = None
+    
+    block_id = data.get('block_id')
+    start_offset = data.get('start_offset')
+    end_offset = data.get('end_offset')
+    if (chapter_index is None or not isinstance(block_id, str) or not block_id
+            or type(start_offset) is not int or type(end_offset) is not int
+            or not 0 <= start_offset <= end_offset):
+        return chapter_index, None, None, None
+    
+    return chapter_index, block_id, start_offset, end_offset
+
+def chapter_to_dict(chapter):
+    """Строка таблицы chapters в JSON представление"""
+    return dict(zip(CHAPTER_COLUMNS.split(', '), chapter))
+
+# Полнотекстовый поиск по главам (FTS5)
+# rowid записи = book_id * FTS_BOOK_STRIDE + chapter_index: все главы книги
+# лежат в одном диапазоне rowid и удаляются без сканирования индекса
+FTS_BOOK_STRIDE = 100000
+
+def index_book_chapters(cursor, book_id, chapters):
+    """Переиндексирует текст глав книги (вызывается в транзакции загрузки)"""
+    remove_book_from_search(cursor, book_id)
+    cursor.executemany('''
+        INSERT INTO chapters_fts (rowid, title, body, book_id, chapter_index)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [
+        (book_id * FTS_BOOK_STRIDE + index, chapter['title'],
+         chapter.get('text') or extract_plain_text(chapter['content']), book_id, index)
+        for index, chapter in enumerate(chapters[:FTS_BOOK_STRIDE])
+    ])
+
+def remove_book_from_search(cursor, book_id):
+    """Удаляет главы книги из полнотекстового индекса"""
+    cursor.execute(
+        'DELETE FROM chapters_fts WHERE rowid >= ? AND rowid < ?',
+        (book_id * FTS_BOOK_STRIDE, (book_id + 1) * FTS_BOOK_STRIDE)
+    )
+
+def build_fts_query(text):
+    """Превращает пользовательский ввод в безопасный запрос FTS5
+    
+    Каждое слово берется в кавычки (операторы FTS5 не интерпретируются),
+    последнее слово ищется по префиксу для поиска по мере ввода.
+    """
+    import re
+    terms = re.findall(r'\w+', text)
+    if not terms:
+        return None
+    quoted = ['"' + term.replace('"', '""') + '"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+def format_snippet(snippet):
+    """Экранирует фрагмент совпадения и подсвечивает найденные слова"""
+    import html
+    return html.escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+# Постраничная выборка (keyset pagination по паре created_at, id)
+BOOK_COLUMNS = 'id, title, author, original_filename, site_path, created_at, chapters_count, cover_small, cover_large'
+NOTE_COLUMNS = 'id, chapter_title, selected_text, note_text, created_at'
+
+def encode_cursor(created_at, row_id):
+    """Кодирует позицию последней строки страницы в непрозрачный курсор"""
+    import base64
+    raw = json.dumps([created_at, row_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    """Декодирует курсор, возвращает (created_at, id) или None для некорректного"""
+    import base64
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        created_at, row_id = json.loads(raw.decode('utf-8'))
+        if isinstance(created_at, str) and type(row_id) is int:
+            return created_at, row_id
+    except Exception:
+        pass
+    return None
+
+def get_page_limit(default):
+    """Размер страницы из параметра limit с ограничением сверху"""
+    limit = request.args.get('limit', default, type=int)
+    return max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+def fetch_books_page(cursor, position, limit):
+    """Страница каталога после позиции (created_at, id), возвращает (книги, следующий курсор)
+    
+    Стоимость запроса не зависит от глубины страницы: индекс по (created_at, id)
+    позиционируется сразу на курсор, без OFFSET.
+    """
+    if position:
+        cursor.execute(f'''
+            SELECT {BOOK_COLUMNS} FROM books
+            WHERE (created_at, id) < (?, ?) AND deleted_at IS NULL
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (*position, limit + 1))
+    else:
+        cursor.execute(f'''
+            SELECT {BOOK_COLUMNS} FROM books
+            WHERE deleted_at IS NULL
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (limit + 1,))
+    books = cursor.fetchall()
+    
+    next_cursor = None
+    if len(books) > limit:
+        books = books[:limit]
+        next_cursor = encode_cursor(books[-1][5], books[-1][0])
+    return books, next_cursor
+
+# Кэш каталога: поколение библиотеки увеличивается триггерами при любом изменении books,
+# поэтому закэшированные страницы верны, пока поколение не изменилось
+_catalog_cache = {'generation': None, 'pages': {}}
+_catalog_cache_lock = threading.Lock()
+
+def get_library_generation(cursor):
+    """Текущее поколение библиотеки (номер последнего изменения таблицы books)"""
+    cursor.execute("SELECT value FROM library_meta WHERE key = 'generation'")
+    return cursor.fetchone()[0]
+
+def fetch_books_page_cached(cursor, position, limit):
+    """fetch_books_page с кэшем, возвращает (поколение, книги, следующий курсор)
+    
+    Поколение читается до страницы, так что в кэш может попасть только
+    страница не старше своего поколения.
+    """
+    generation = get_library_generation(cursor)
+    key = (position, limit)
+    with _catalog_cache_lock:
+        if _catalog_cache['generation'] != generation:
+            _catalog_cache['generation'] = generation
+            _catalog_cache['pages'] = {}
+        page = _catalog_cache['pages'].get(key)
+    
+    if page is None:
+        page = fetch_books_page(cursor, position, limit)
+        with _catalog_cache_lock:
+            pages = _catalog_cache['pages']
+            if _catalog_cache['generation'] == generation and len(pages) < app.config['CATALOG_CACHE_PAGES']:
+                pages[key] = page
+    return (generation, *page)
+
+def catalog_etag(generation, *parts):
+    """ETag страницы каталога: поколение библиотеки, версии шаблонов и параметры запроса"""
+    templates = Path(app.root_path, app.template_folder)
+    versions = []
+    for name in ('base.html', 'index.html'):
+        stat = (templates / name).stat()
+        versions.append([stat.st_mtime_ns, stat.st_size])
+    raw = json.dumps([generation, versions, *parts], ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def catalog_not_modified(etag):
+    """Ответ 304, если у клиента актуальная версия каталога, иначе None
+    
+    Страница с ожидающими flash-сообщениями всегда отдается целиком,
+    иначе сообщение не будет показано.
+    """
+    if session.get('_flashes') or not request.if_none_match.contains(etag):
+        return None
+    response = app.response_class(status=304)
+    return with_catalog_etag(response, etag)
+
+def with_catalog_etag(response, etag):
+    """Добавляет ETag; браузер перепроверяет каталог при каждом показе"""
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def fetch_notes_page(cursor, book_id, position, limit):
+    """Страница заметок книги после позиции (created_at, id), возвращает (заметки, следующий курсор)"""
+    if position:
+        cursor.execute(f'''
+            SELECT {NOTE_COLUMNS} FROM notes
+            WHERE book_id = ? AND (created_at, id) < (?, ?)
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (book_id, *position, limit + 1))
+    else:
+        cursor.execute(f'''
+            SELECT {NOTE_COLUMNS} FROM notes
+            WHERE book_id = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (book_id, limit + 1))
+    notes = cursor.fetchall()
+    
+    next_cursor = None
+    if len(notes) > limit:
+        notes = notes[:limit]
+        next_cursor = encode_cursor(notes[-1][4], notes[-1][0])
+    return notes, next_cursor
+
+def book_to_dict(book):
+    """Строка таблицы books в JSON представление"""
+    return {
+        'id': book[0],
+        'title': book[1],
+        'author': book[2],
+        'original_filename': book[3],
+        'site_path': book[4],
+        'created_at': book[5],
+        'chapters_count': book[6],
+        'cover': {
+            'small': url_for('cover_file', filename=book[7]),
+            'large': url_for('cover_file', filename=book[8])
+        } if book[7] else None
+    }
+
+def note_to_dict(note):
+    """Строка таблицы notes в JSON представление"""
+    return {
+        'id': note[0],
+        'chapter_title': note[1],
+        'selected_text': note[2],
+        'note_text': note[3],
+        'created_at': note[4]
+    }
+
+def cleanup_site_builds():
+    """Удаляет недособранные и осиротевшие папки сайтов (вызывается при запуске)
+    
+    Удаляются временные папки сборки и замены, оставшиеся после сбоя, а также
+    опубликованные приложением сайты, на которые не ссылается ни одна книга
+    (сбой между публикацией и записью в БД). Папки без отметки не трогаются.
+    """
+    with get_db_pool().connection() as conn:
+        referenced = {row[0] for row in conn.execute('SELECT site_path FROM books')}
+    
+    books_folder = Path(app.config['BOOKS_FOLDER'])
+    removed = 0
+    for entry in books_folder.iterdir():
+        if entry.is_dir() and entry.name.startswith((BUILD_DIR_PREFIX, OLD_DIR_PREFIX)):
+            shutil.rmtree(entry, ignore_errors=True)
+            removed += 1
+    
+    for site in iter_site_folders(books_folder):
+        if (site / SITE_MARKER_NAME).exists() and site.relative_to(books_folder).as_posix() not in referenced:
+            shutil.rmtree(site, ignore_errors=True)
+            removed += 1
+    
+    # Файлы блокировок прежнего формата (по одному на путь сайта)
+    locks_dir = books_folder / LOCKS_DIR_NAME
+    if locks_dir.is_dir():
+        for lock_file in locks_dir.glob('*.lock'):
+            if len(lock_file.stem) == 40:
+                lock_file.unlink(missing_ok=True)
+    
+    if removed:
+        print(f"Удалено незавершенных и неиспользуемых папок сайтов: {removed}")
+
+# Корзина удаленных книг
+def move_book_to_trash(conn, book_id, site_path):
+    """Помечает книгу удаленной и переносит папку ее сайта в books/.trash
+    
+    Запись получает deleted_at и путь в корзине (прежний site_path освобождается
+    для новой загрузки), папка переносится одним rename. Файлы, заметки и
+    поисковый индекс удаляет фоновый сборщик (reap_trash).
+    Отметка фиксируется только после переноса папки: если rename не удался,
+    книга остается в библиотеке и функция возвращает False. Если книгу уже
+    удалил параллельный запрос, папка не трогается и возвращается None.
+    """
+    books_folder = Path(app.config['BOOKS_FOLDER'])
+    site = books_folder / site_path
+    trash_path = f"{TRASH_DIR_NAME}/{book_id}-{uuid.uuid4().hex}"
+    
+    with site_lock(site, books_folder):
+        updated = conn.execute('''
+            UPDATE books SET deleted_at = CURRENT_TIMESTAMP, site_path = ?
+            WHERE id = ? AND deleted_at IS NULL
+        ''', (trash_path, book_id)).rowcount
+        if not updated:
+            # site_path мог уже занять сайт книги, загруженной заново после удаления
+            conn.rollback()
+            return None
+        
+        moved = False
+        try:
+            (books_folder / TRASH_DIR_NAME).mkdir(exist_ok=True)
+            if site.exists():
+                os.rename(site, books_folder / trash_path)
+                moved = True
+            conn.commit()
+        except OSError as e:
+            conn.rollback()
+            print(f"Не удалось перенести сайт книги {book_id} в корзину: {e}")
+            return False
+        except sqlite3.Error:
+            conn.rollback()
+            # Без отметки в БД папка должна вернуться на прежнее место
+            if moved:
+                os.rename(books_folder / trash_path, site)
+            raise
+    return True
+
+def remove_tree_throttled(path, files_per_second):
+    """Удаляет папку, ограничивая скорость удаления файлов (не нагружает диск и сетевые ФС)"""
+    delay = 1.0 / files_per_second if files_per_second else 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            try:
+                os.unlink(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+            if delay:
+                time.sleep(delay)
+        os.rmdir(root)
+
+def reap_trash():
+    """Окончательно удаляет книги из корзины, возвращает число удаленных книг
+    
+    Сначала удаляются файлы сайта, затем запись книги; заметки, главы и промежуточное
+    представление удаляются каскадно (индекс заметок - триггерами), главы из поискового
+    индекса - явно.
+    """
+    with get_db_pool().connection() as conn:
+        trashed = conn.execute(
+            'SELECT id, site_path FROM books WHERE deleted_at IS NOT NULL ORDER BY deleted_at'
+        ).fetchall()
+    
+    for book_id, site_path in trashed:
+        if site_path.startswith(TRASH_DIR_NAME + '/'):
+            path = Path(app.config['BOOKS_FOLDER']) / site_path
+            if path.exists():
+                remove_tree_throttled(path, app.config['TRASH_REAP_FILES_PER_SECOND'])
+        
+        # Соединение берется только на время удаления записей, не на время удаления файлов
+        with get_db_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM books WHERE id = ? AND deleted_at IS NOT NULL', (book_id,))
+            remove_book_from_search(cursor, book_id)
+            conn.commit()
+    
+    return len(trashed)
+
+_trash_reaper = {'thread': None, 'wake': threading.Event()}
+_trash_reaper_lock = threading.Lock()
+
+def _trash_reaper_loop():
+    """Фоновый поток: очищает корзину по сигналу и раз в TRASH_REAP_INTERVAL секунд"""
+    wake = _trash_reaper['wake']
+    while True:
+        wake.wait(app.config['TRASH_REAP_INTERVAL'])
+        wake.clear()
+        try:
+            reap_trash()
+        except Exception as e:
+            print(f"Ошибка очистки корзины: {e}")
+
+def wake_trash_reaper():
+    """Будит сборщик корзины, запуская его поток при первом вызове"""
+    with _trash_reaper_lock:
+        thread = _trash_reaper['thread']
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_trash_reaper_loop, name='trash-reaper', daemon=True)
+            _trash_reaper['thread'] = thread
+            thread.start()
+    _trash_reaper['wake'].set()
+
+# Ограничение одновременных тяжелых операций
+class AdmissionController:
+    """Ограничивает число одновременных операций одного класса и длину очереди к ним
+    
+    Запрос сверх лимита ждет освобождения места не дольше timeout, если в
+    очереди есть место; иначе получает отказ, и клиент должен повторить позже.
+    """
+    
+    def __init__(self, name, limit, max_queue, timeout):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+    
+    def acquire(self):
+        """Занимает место для операции, возвращает False при перегрузке"""
+        with self._cond:
+            # Новые запросы не обгоняют уже ждущие в очереди
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+            
+            self.waiting += 1
+            try:
+                admitted = self._cond.wait_for(lambda: self.active < self.limit, timeout=self.timeout)
+            finally:
+                self.waiting -= 1
+            
+            if admitted:
+                self.active += 1
+            else:
+                self.rejected += 1
+            return admitted
+    
+    def release(self):
+        """Освобождает место и будит следующий запрос из очереди"""
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+    
+    def stats(self):
+        """Текущая загрузка для мониторинга"""
+        with self._cond:
+            return {
+                'active': self.active,
+                'waiting': self.waiting,
+                'limit': self.limit,
+                'queue_size': self.max_queue,
+                'rejected': self.rejected
+            }
+
+# Классы операций: имя -> (ключ лимита, ключ размера очереди) в app.config
+ADMISSION_CLASSES = {
+    'ingest': ('INGEST_CONCURRENCY', 'INGEST_QUEUE_SIZE'),
+    'export': ('EXPORT_CONCURRENCY', 'EXPORT_QUEUE_SIZE'),
+}
+
+_admission_controllers = {}
+_admission_lock = threading.Lock()
+
+def get_admission_controller(name):
+    """Возвращает контроллер класса операций, создавая его при первом обращении"""
+    with _admission_lock:
+        controller = _admission_controllers.get(name)
+        if controller is None:
+            limit_key, queue_key = ADMISSION_CLASSES[name]
+            controller = AdmissionController(
+                name,
+                limit=app.config[limit_key],
+                max_queue=app.config[queue_key],
+                timeout=app.config['ADMISSION_QUEUE_TIMEOUT']
+            )
+            _admission_controllers[name] = controller
+        return controller
+
+def admission_controlled(name, methods=None):
+    """Декоратор маршрута: пропускает запрос только при наличии места в классе операций
+    
+    methods ограничивает проверку указанными HTTP методами (например, только POST
+    для формы загрузки). При перегрузке возвращается 503 с заголовком Retry-After.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if methods is not None and request.method not in methods:
+                return view(*args, **kwargs)
+            
+            controller = get_admission_controller(name)
+            if not controller.acquire():
+                retry_after = app.config['ADMISSION_RETRY_AFTER']
+                response = jsonify({
+                    'error': 'Сервер перегружен, повторите попытку позже',
+                    'retry_after': retry_after
+                })
+                response.status_code = 503
+                response.headers['Retry-After'] = str(retry_after)
+                return response
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release()
+        return wrapped
+    return decorator
+
+# Изолированное выполнение загрузки и экспорта книг
+class SandboxError(Exception):
+    """Задача в дочернем процессе не уложилась в лимиты или завершилась аварийно"""
+
+_sandbox_context = None
+_sandbox_context_lock = threading.Lock()
+
+# Профили потоков дочернего процесса, если веб-процесс профилирует запрос (иначе None)
+_sandbox_profiles = None
+_sandbox_profiles_lock = threading.Lock()
+
+def get_sandbox_context():
+    """Контекст multiprocessing для изолированных задач
+    
+    forkserver порождает процессы из чистого процесса с уже импортированным
+    приложением: быстро и без потоков, блокировок и соединений с БД веб-процесса.
+    Где forkserver недоступен, используется spawn.
+    """
+    global _sandbox_context
+    with _sandbox_context_lock:
+        if _sandbox_context is None:
+            import multiprocessing
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                _sandbox_context = multiprocessing.get_context('forkserver')
+                _sandbox_context.set_forkserver_preload([__name__])
+            else:
+                _sandbox_context = multiprocessing.get_context('spawn')
+    return _sandbox_context
+
+def sandbox_profiled(func, *args):
+    """Выполняет func(*args) под своим cProfile, если дочерний процесс профилирует запрос
+    
+    cProfile видит только поток, в котором включен, поэтому задача оборачивает
+    в sandbox_profiled работу каждого своего потока.
+    """
+    if _sandbox_profiles is None:
+        return func(*args)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        with _sandbox_profiles_lock:
+            _sandbox_profiles.append(profiler)
+
+def _sandbox_main(conn, job, args, config, cwd, profile):
+    """Точка входа дочернего процесса: лимиты ресурсов, настройки веб-процесса и задача"""
+    global _sandbox_profiles
+    try:
+        import resource
+        if config['SANDBOX_MEMORY_LIMIT']:
+            resource.setrlimit(resource.RLIMIT_AS, (config['SANDBOX_MEMORY_LIMIT'],) * 2)
+        if config['SANDBOX_CPU_LIMIT']:
+            # Мягкий лимит присылает SIGXCPU, жесткий через секунду - SIGKILL
+            resource.setrlimit(resource.RLIMIT_CPU, (config['SANDBOX_CPU_LIMIT'], config['SANDBOX_CPU_LIMIT'] + 1))
+    except ImportError:
+        pass
+    
+    os.chdir(cwd)
+    app.config.update(config)
+    _sandbox_profiles = [] if profile else None
+    try:
+        result = ('ok', sandbox_profiled(job, *args))
+    except MemoryError:
+        result = ('error', 'превышен лимит памяти')
+    except Exception as e:
+        result = ('error', f'{type(e).__name__}: {e}')
+    # Статистика всех потоков одним словарем pstats, его добавит в профиль запроса веб-процесс
+    profile_stats = pstats.Stats(*_sandbox_profiles).stats if _sandbox_profiles else None
+    conn.send((*result, metrics.snapshot(), profile_stats))
     conn.close()
 
+def describe_sandbox_exit(exitcode):
+    """Причина завершения дочернего процесса, не вернувшего результат"""
+    import signal
+    if exitcode == -getattr(signal, 'SIGXCPU', 0):
+        return 'превышен лимит процессорного времени'
+    if exitcode == -getattr(signal, 'SIGKILL', 0):
+        return 'процесс принудительно завершен (лимит процессорного времени или памяти)'
+    return f'процесс завершился с кодом {exitcode}'
+
+def run_sandboxed(job, *args, timeout):
+    """Выполняет job(*args) в дочернем процессе с лимитами SANDBOX_* и таймаутом
+    
+    Возвращает результат задачи, при таймауте, превышении лимитов или исключении
+    в задаче - SandboxError. Метрики, накопленные задачей, переносятся в веб-процесс.
+    Если запрос профилируется, задача профилируется и в дочернем процессе, а ее
+    статистика попадает в профиль запроса.
+    При SANDBOX_ENABLED = False задача выполняется в текущем процессе.
+    """
+    if not app.config['SANDBOX_ENABLED']:
+        return job(*args)
+    
+    profile = has_request_context() and g.get('profiler') is not None
+    context = get_sandbox_context()
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_sandbox_main,
+                              args=(sender, job, args, dict(app.config), os.getcwd(), profile),
+                              name=f'sandbox-{job.__name__}', daemon=True)
+    process.start()
+    sender.close()
+    
+    try:
+        if not receiver.poll(timeout):
+            raise SandboxError(f'обработка не уложилась в {timeout} с')
+        try:
+            status, payload, snapshot, profile_stats = receiver.recv()
+        except EOFError:
+            process.join()
+            raise SandboxError(describe_sandbox_exit(process.exitcode))
+    except SandboxError:
+        STAGE_ERRORS.inc(stage=f'sandbox_{job.__name__}')
+        raise
+    finally:
+        if process.is_alive():
+            process.terminate()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+        process.join()
+        receiver.close()
+    
+    metrics.merge(snapshot)
+    if profile_stats:
+        g.setdefault('sandbox_profiles', []).append(profile_stats)
+    if status != 'ok':
+        STAGE_ERRORS.inc(stage=f'sandbox_{job.__name__}')
+        raise SandboxError(payload)
+    return payload
+
+def ingest_book(epub_path, build_path):
+    """Задача загрузки книги: разбор EPUB, сайт и миниатюры обложки
+    
+    Возвращает (загружен ли EPUB, облегченный обработчик, путь сайта или None, обложки,
+    промежуточное представление книги или None).
+    Сайт только собирается в build_path: публикует его веб-процесс после успешного
+    завершения задачи, поэтому прерванная задача не оставляет сайта без записи в БД.
+    """
+    processor = EPUBProcessor()
+    if not processor.load_epub(epub_path):
+        return False, processor.detached(), None, {}, None
+    
+    site_path = processor.create_website(app.config['BOOKS_FOLDER'], build_path, publish=False)
+    covers = {}
+    if site_path:
+        covers = processor.create_cover_thumbnails(app.config['COVERS_FOLDER']) or {}
+    return True, processor.detached(), site_path, covers, processor.to_ir()
+
+def export_chapters(epub_path, book_title, book_author, requests, ir=None):
+    """Задача экспорта: загружает книгу один раз и экспортирует главы [(номер, формат)]
+    
+    Главы экспортируются параллельно в EXPORT_WORKERS потоках. Книга берется из промежуточного представления ir, без него - из разбора EPUB.
+    Возвращает (результаты по порядку, новое промежуточное представление или None):
+    результат - {'data', 'filename', 'mimetype'} или {'error', 'status'};
+    представление возвращается, только если пришлось разбирать EPUB.
+    """
+    processor = EPUBProcessor()
+    if ir is not None:
+        processor.load_ir(ir, epub_path)
+        # Главы, для которых есть только оглавление (load_chapters_outline), читаются из EPUB
+        processor.load_chapter_contents(sorted({
+            chapter_index for chapter_index, _ in requests
+            if chapter_index < len(processor.chapters) and processor.chapters[chapter_index]['content'] is None
+        }))
+    elif not processor.load_epub(epub_path):
+        return [{'error': 'Ошибка при загрузке EPUB файла', 'status': 500}] * len(requests), None
+    
+    def export_one(chapter_request):
+        chapter_index, format = chapter_request
+        if chapter_index >= len(processor.chapters):
+            return {'error': 'Глава не найдена', 'status': 404}
+        try:
+            exported = export_chapter_file(processor, chapter_index, format, book_title, book_author)
+        except Exception as e:
+            print(f"Ошибка экспорта главы {chapter_index} в {format}: {e}")
+            exported = None
+        
+        if exported is None:
+            return {'error': f'Ошибка при создании {format.upper()} файла', 'status': 500}
+        buffer, filename, mimetype = exported
+        return {'data': buffer.getvalue(), 'filename': filename, 'mimetype': mimetype}
+    
+    # Загруженная книга при экспорте только читается, потоки делят один обработчик
+    with ThreadPoolExecutor(max_workers=max(1, min(app.config['EXPORT_WORKERS'], len(requests)))) as pool:
+        results = list(pool.map(sandbox_profiled, [export_one] * len(requests), requests))
+    return results, (processor.to_ir() if ir is None else None)
+
+# Метрики запросов и загрузки
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_duration(response):
+    """Записывает время обработки запроса по шаблону маршрута (а не по конкретному URL)"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_DURATION.observe(time.perf_counter() - started,
+                                 route=route, method=request.method, status=response.status_code)
+    return response
+
+def _admission_samples(field):
+    """Значения поля статистики по всем классам операций (для метрик)"""
+    return {(name,): get_admission_controller(name).stats()[field] for name in ADMISSION_CLASSES}
+
+metrics.register(CallbackMetric(
+    'epub_cutter_admission_active', 'Выполняющиеся тяжелые операции', ('class',),
+    lambda: _admission_samples('active')))
+metrics.register(CallbackMetric(
+    'epub_cutter_admission_waiting', 'Операции в очереди', ('class',),
+    lambda: _admission_samples('waiting')))
+metrics.register(CallbackMetric(
+    'epub_cutter_admission_rejected_total', 'Операции, отклоненные из-за перегрузки', ('class',),
+    lambda: _admission_samples('rejected'), type_name='counter'))
+
+# Профилирование запросов
+# При выключенном PROFILING_ENABLED обработчики ограничиваются одной проверкой настройки
+def should_profile_request():
+    """Решает, профилировать ли текущий запрос
+    
+    Профилируются только запросы вошедших пользователей: по доле из
+    PROFILING_SAMPLE_RATES или принудительно параметром ?profile=1.
+    """
+    if not current_user.is_authenticated:
+        return False
+    if request.args.get('profile') == '1':
+        return True
+    rate = app.config['PROFILING_SAMPLE_RATES'].get(request.endpoint, 0)
+    return rate > 0 and random.random() < rate
+
+class SandboxProfile:
+    """Статистика cProfile, присланная дочерним процессом, в виде, который принимает pstats.Stats"""
+    
+    def __init__(self, stats):
+        self.stats = stats
+    
+    def create_stats(self):
+        pass
+
+def save_profile(profiler, response):
+    """Сохраняет профиль запроса (.prof) и текстовую сводку (.txt), удаляет старые профили
+    
+    В профиль добавляется статистика дочерних процессов, выполнявших задачи запроса.
+    """
+    import re
+    
+    folder = Path(app.config['PROFILES_FOLDER'])
+    folder.mkdir(parents=True, exist_ok=True)
+    
+    sandbox_profiles = g.pop('sandbox_profiles', [])
+    summary = io.StringIO()
+    summary.write(f"{request.method} {request.full_path.rstrip('?')} -> {response.status_code}\n")
+    summary.write(f"Время: {time.perf_counter() - g.profile_started:.3f} с\n")
+    summary.write(f"Дочерних процессов: {len(sandbox_profiles)}\n\n")
+    stats = pstats.Stats(profiler, stream=summary)
+    for profile_stats in sandbox_profiles:
+        stats.add(SandboxProfile(profile_stats))
+    
+    endpoint = re.sub(r'[^\w]', '_', request.endpoint or 'unmatched')
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}_{endpoint}_{uuid.uuid4().hex[:8]}"
+    stats.dump_stats(folder / f'{name}.prof')
+    
+    stats.strip_dirs().sort_stats('cumulative').print_stats(app.config['PROFILING_TOP_N'])
+    (folder / f'{name}.txt').write_text(summary.getvalue(), encoding='utf-8')
+    
+    # Храним только последние PROFILES_KEEP профилей
+    profiles = sorted(folder.glob('*.prof'), key=lambda path: path.stat().st_mtime)
+    for old in profiles[:-app.config['PROFILES_KEEP']]:
+        old.unlink(missing_ok=True)
+        old.with_suffix('.txt').unlink(missing_ok=True)
+
+@app.before_request
+def start_request_profiler():
+    if not app.config['PROFILING_ENABLED'] or not should_profile_request():
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # В потоке уже работает другой профилировщик
+        return
+    g.profiler = profiler
+    g.profile_started = time.perf_counter()
+
+@app.after_request
+def stop_request_profiler(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        try:
+            save_profile(profiler, response)
+        except Exception as e:
+            print(f"Ошибка при сохранении профиля: {e}")
+    return response
+
+@app.teardown_request
+def discard_request_profiler(exception):
+    """Выключает профилировщик, если запрос завершился необработанной ошибкой"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+@app.route('/admin/profiles')
+@login_required
+def list_profiles():
+    """Список сохраненных профилей запросов, новые первыми"""
+    folder = Path(app.config['PROFILES_FOLDER'])
+    profiles = sorted(folder.glob('*.prof'), key=lambda path: path.stat().st_mtime, reverse=True) if folder.is_dir() else []
+    return jsonify({
+        'enabled': app.config['PROFILING_ENABLED'],
+        'profiles': [{
+            'name': path.stem,
+            'size': path.stat().st_size,
+            'created_at': datetime.fromtimestamp(path.stat().st_mtime).isoformat(timespec='seconds'),
+            'prof_url': url_for('download_profile', filename=path.name),
+            'summary_url': url_for('download_profile', filename=path.with_suffix('.txt').name)
+        } for path in profiles]
+    })
+
+@app.route('/admin/profiles/<filename>')
+@login_required
+def download_profile(filename):
+    """Скачивание профиля (.prof для pstats/snakeviz) или его текстовой сводки (.txt)"""
+    if not filename.endswith(('.prof', '.txt')):
+        return jsonify({'error': 'Профиль не найден'}), 404
+    return send_from_directory(os.path.abspath(app.config['PROFILES_FOLDER']), filename,
+                               as_attachment=filename.endswith('.prof'))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики приложения в текстовом формате Prometheus
+    
+    Доступны вошедшему пользователю, а при заданном METRICS_TOKEN - также
+    по заголовку Authorization: Bearer <токен> (для сборщика метрик).
+    """
+    token = app.config['METRICS_TOKEN']
+    has_token = bool(token) and request.headers.get('Authorization') == f'Bearer {token}'
+    if not has_token and not current_user.is_authenticated:
+        if token:
+            return jsonify({'error': 'Доступ запрещен'}), 401
+        return login_manager.unauthorized()
+    return app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # Маршруты Flask
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -1597,17 +4003,49 @@ def logout():
 @login_required
 def index():
     """Главная страница с каталогом книг"""
-    # Получаем список всех книг из базы данных
-    conn = sqlite3.connect('books.db')
+    # Первая страница каталога, остальные подгружаются через /api/books
+    position = decode_cursor(request.args.get('cursor', ''))
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM books ORDER BY created_at DESC')
-    books = cursor.fetchall()
-    conn.close()
+    generation, books, next_cursor = fetch_books_page_cached(cursor, position, app.config['CATALOG_PAGE_SIZE'])
+    
+    # Страница показывает имя пользователя, поэтому оно входит в ETag
+    etag = catalog_etag(generation, 'index', position, current_user.id)
+    not_modified = catalog_not_modified(etag)
+    if not_modified:
+        return not_modified
+    
+    response = app.make_response(render_template('index.html', books=books, next_cursor=next_cursor))
+    return with_catalog_etag(response, etag)
+
+@app.route('/api/books')
+@login_required
+def list_books():
+    """Страница каталога книг в JSON (курсор из next_cursor предыдущего ответа)"""
+    token = request.args.get('cursor')
+    position = decode_cursor(token) if token else None
+    if token and position is None:
+        return jsonify({'error': 'Некорректный курсор'}), 400
+    
+    limit = get_page_limit(app.config['CATALOG_PAGE_SIZE'])
+    conn = get_db()
+    cursor = conn.cursor()
+    generation, books, next_cursor = fetch_books_page_cached(cursor, position, limit)
+    
+    etag = catalog_etag(generation, 'api', position, limit)
+    not_modified = catalog_not_modified(etag)
+    if not_modified:
+        return not_modified
     
-    return render_template('index.html', books=books)
+    response = jsonify({
+        'books': [book_to_dict(book) for book in books],
+        'next_cursor': next_cursor
+    })
+    return with_catalog_etag(response, etag)
 
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
+@admission_controlled('ingest', methods=('POST',))
 def upload_book():
     """Страница загрузки новой книги"""
     if request.method == 'POST':
@@ -1622,29 +4060,60 @@ def upload_book():
         if file and file.filename.lower().endswith('.epub'):
             # Сохраняем загруженный файл
             filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            # Уникальное имя, чтобы параллельные загрузки одного файла не мешали друг другу
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}_{filename}")
             file.save(file_path)
             
-            # Обрабатываем EPUB файл
-            processor = EPUBProcessor()
-            if processor.load_epub(file_path):
-                # Создаем веб-сайт книги
-                site_path = processor.create_website(app.config['BOOKS_FOLDER'])
-                
+            # Разбор EPUB, создание сайта и обложек - в дочернем процессе с лимитами
+            build_path = os.path.join(app.config['BOOKS_FOLDER'], f"{BUILD_DIR_PREFIX}{uuid.uuid4().hex}")
+            try:
+                loaded, processor, site_path, covers, ir = run_sandboxed(
+                    ingest_book, file_path, build_path, timeout=app.config['INGEST_TIMEOUT'])
+            except SandboxError as e:
+                # Прерванная сборка оставляет только папку сборки
+                shutil.rmtree(build_path, ignore_errors=True)
+                os.remove(file_path)
+                return jsonify({'error': f'Ошибка при обработке EPUB файла: {e}'}), 500
+            
+            if loaded and site_path:
+                try:
+                    with STAGE_DURATION.time(stage='publish'):
+                        publish_site(build_path, site_path)
+                except OSError as e:
+                    print(f"Ошибка при публикации сайта книги: {e}")
+                    STAGE_ERRORS.inc(stage='publish')
+                    site_path = None
+            
+            if loaded:
                 if site_path:
                     # Сохраняем информацию в базу данных
-                    conn = sqlite3.connect('books.db')
-                    cursor = conn.cursor()
-                    # Получаем относительный путь от папки books
-                    relative_site_path = os.path.relpath(site_path, app.config['BOOKS_FOLDER']).replace('\\', '/')
-                    cursor.execute('''
-                        INSERT INTO books (title, author, original_filename, site_path, chapters_count)
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (processor.book_title, processor.book_author, filename, 
-                          relative_site_path, len(processor.chapters)))
-                    book_id = cursor.lastrowid
-                    conn.commit()
-                    conn.close()
+                    with STAGE_DURATION.time(stage='db_insert'):
+                        conn = get_db()
+                        cursor = conn.cursor()
+                        # Получаем относительный путь от папки books
+                        relative_site_path = os.path.relpath(site_path, app.config['BOOKS_FOLDER']).replace('\\', '/')
+                        # Повторная загрузка книги в ту же папку обновляет существующую запись
+                        cursor.execute('''
+                            INSERT INTO books (title, author, original_filename, site_path, chapters_count,
+                                               cover_small, cover_large)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (site_path) DO UPDATE SET
+                                title = excluded.title,
+                                author = excluded.author,
+                                original_filename = excluded.original_filename,
+                                chapters_count = excluded.chapters_count,
+                                cover_small = excluded.cover_small,
+                                cover_large = excluded.cover_large
+                        ''', (processor.book_title, processor.book_author, filename, 
+                              relative_site_path, len(processor.chapters),
+                              covers.get('small'), covers.get('large')))
+                        cursor.execute('SELECT id FROM books WHERE site_path = ?', (relative_site_path,))
+                        book_id = cursor.fetchone()[0]
+                        save_book_chapters(cursor, book_id, processor)
+                        save_book_toc(cursor, book_id, processor)
+                        save_book_ir(cursor, book_id, ir)
+                        index_book_chapters(cursor, book_id, processor.chapters)
+                        conn.commit()
                     
                     # Удаляем временный файл
                     os.remove(file_path)
@@ -1655,15 +4124,19 @@ def upload_book():
                         'title': processor.book_title,
                         'author': processor.book_author,
                         'chapters_count': len(processor.chapters),
-                        'site_path': relative_site_path
+                        'site_path': relative_site_path,
+                        'minify': processor.minify_stats
                     })
                 else:
-                    # Удаляем временный файл в случае ошибки создания сайта
+                    # Удаляем временный файл и папку сборки в случае ошибки создания сайта
+                    shutil.rmtree(build_path, ignore_errors=True)
                     os.remove(file_path)
                     return jsonify({'error': 'Ошибка при создании сайта книги'}), 500
             else:
                 # Удаляем временный файл в случае ошибки обработки EPUB
                 os.remove(file_path)
+                if processor.load_error:
+                    return jsonify({'error': f'EPUB отклонен: {processor.load_error}'}), 400
                 return jsonify({'error': 'Ошибка при обработке EPUB файла'}), 500
         else:
             return jsonify({'error': 'Недопустимый формат файла. Поддерживается только EPUB'}), 400
@@ -1683,59 +4156,78 @@ def book_file(book_path, filename):
     full_path = os.path.join(app.config['BOOKS_FOLDER'], book_path)
     return send_from_directory(full_path, filename)
 
+@app.route('/covers/<path:filename>')
+@login_required
+def cover_file(filename):
+    """Миниатюра обложки: имя файла - хэш содержимого, поэтому ответ кэшируется навсегда"""
+    response = send_from_directory(os.path.abspath(app.config['COVERS_FOLDER']), filename,
+                                   max_age=COVER_CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/delete/<int:book_id>', methods=['POST'])
 @login_required
 def delete_book(book_id):
     """Удаление книги"""
-    conn = sqlite3.connect('books.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT site_path FROM books WHERE id = ?', (book_id,))
+    cursor.execute('SELECT site_path FROM books WHERE id = ? AND deleted_at IS NULL', (book_id,))
     result = cursor.fetchone()
     
     if result:
-        site_path = result[0]
-        # Удаляем папку с сайтом книги
-        import shutil
-        full_site_path = os.path.join(app.config['BOOKS_FOLDER'], site_path)
-        if os.path.exists(full_site_path):
-            shutil.rmtree(full_site_path)
-        
-        # Удаляем запись из базы данных
-        cursor.execute('DELETE FROM books WHERE id = ?', (book_id,))
-        conn.commit()
-        conn.close()
+        # Книга сразу исчезает из каталога, файлы и записи удаляются в фоне
+        moved = move_book_to_trash(conn, book_id, result[0])
+        if moved is None:
+            return jsonify({'error': 'Книга не найдена'}), 404
+        if not moved:
+            return jsonify({'error': 'Не удалось удалить книгу'}), 500
+        wake_trash_reaper()
         
         return jsonify({'success': True})
     else:
-        conn.close()
         return jsonify({'error': 'Книга не найдена'}), 404
 
 @app.route('/notes/<int:book_id>')
 @login_required
 def view_notes(book_id):
     """Просмотр заметок для книги"""
-    conn = sqlite3.connect('books.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     # Получаем информацию о книге
-    cursor.execute('SELECT title, author FROM books WHERE id = ?', (book_id,))
+    cursor.execute('SELECT title, author FROM books WHERE id = ? AND deleted_at IS NULL', (book_id,))
     book = cursor.fetchone()
     
     if not book:
-        conn.close()
         return redirect(url_for('index'))
     
-    # Получаем все заметки для книги
-    cursor.execute('''
-        SELECT id, chapter_title, selected_text, note_text, created_at 
-        FROM notes 
-        WHERE book_id = ? 
-        ORDER BY created_at DESC
-    ''', (book_id,))
-    notes = cursor.fetchall()
-    conn.close()
+    # Первая страница заметок, остальные подгружаются через API
+    notes, next_cursor = fetch_notes_page(cursor, book_id, None, app.config['NOTES_PAGE_SIZE'])
+    cursor.execute('SELECT COUNT(*) FROM notes WHERE book_id = ?', (book_id,))
+    notes_total = cursor.fetchone()[0]
     
-    return render_template('notes.html', book=book, notes=notes, book_id=book_id)
+    return render_template('notes.html', book=book, notes=notes, book_id=book_id,
+                           notes_total=notes_total, next_cursor=next_cursor)
+
+@app.route('/api/books/<int:book_id>/notes')
+@login_required
+def list_notes(book_id):
+    """Страница заметок книги в JSON (курсор из next_cursor предыдущего ответа)"""
+    token = request.args.get('cursor')
+    position = decode_cursor(token) if token else None
+    if token and position is None:
+        return jsonify({'error': 'Некорректный курсор'}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    if not is_book_available(cursor, book_id):
+        return jsonify({'error': 'Книга не найдена'}), 404
+    notes, next_cursor = fetch_notes_page(cursor, book_id, position, get_page_limit(app.config['NOTES_PAGE_SIZE']))
+    
+    return jsonify({
+        'notes': [note_to_dict(note) for note in notes],
+        'next_cursor': next_cursor
+    })
 
 @app.route('/api/notes', methods=['POST'])
 @login_required
@@ -1745,21 +4237,127 @@ def save_note():
     
     if not data or not all(k in data for k in ('book_id', 'chapter_title', 'selected_text')):
         return jsonify({'error': 'Недостаточно данных'}), 400
+    if type(data['book_id']) is not int:
+        return jsonify({'error': 'Некорректные данные'}), 400
     
-    conn = sqlite3.connect('books.db')
+    conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        INSERT INTO notes (book_id, chapter_title, selected_text, note_text)
-        VALUES (?, ?, ?, ?)
-    ''', (data['book_id'], data['chapter_title'], data['selected_text'], data.get('note_text', '')))
+    # Заметка к книге в корзине исчезла бы вместе с книгой
+    if not is_book_available(cursor, data['book_id']):
+        return jsonify({'error': 'Книга не найдена'}), 404
+    
+    try:
+        cursor.execute('''
+            INSERT INTO notes (book_id, chapter_title, selected_text, note_text,
+                               chapter_index, block_id, start_offset, end_offset)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (data['book_id'], data['chapter_title'], data['selected_text'], data.get('note_text', ''),
+              *note_anchor(data)))
+    except sqlite3.IntegrityError:
+        # Внешние ключи включены: заметка к несуществующей книге не сохраняется
+        return jsonify({'error': 'Книга не найдена'}), 404
     
     note_id = cursor.lastrowid
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True, 'note_id': note_id})
 
+@app.route('/api/notes/batch', methods=['POST'])
+@login_required
+def batch_notes():
+    """Пакетное создание, изменение и удаление заметок в одной транзакции
+    
+    Принимает {"operations": [{"op": "create", "book_id", "chapter_title", "selected_text", "note_text"},
+    {"op": "update", "id", "note_text"}, {"op": "delete", "id"}]}. Ошибка отдельной операции
+    не отменяет остальные: результат по каждой возвращается в том же порядке.
+    """
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+    
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'Не указан список операций'}), 400
+    
+    if len(operations) > app.config['NOTES_BATCH_MAX_OPERATIONS']:
+        return jsonify({'error': f"Слишком много операций: максимум {app.config['NOTES_BATCH_MAX_OPERATIONS']}"}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    results = []
+    
+    try:
+        for operation in operations:
+            if not isinstance(operation, dict):
+                results.append({'status': 'error', 'error': 'Некорректная операция'})
+                continue
+            
+            result = {'op': operation.get('op')}
+            if 'client_id' in operation:
+                result['client_id'] = operation['client_id']
+            results.append(result)
+            
+            if operation.get('op') == 'create':
+                if not all(k in operation for k in ('book_id', 'chapter_title', 'selected_text')):
+                    result.update({'status': 'error', 'error': 'Недостаточно данных'})
+                    continue
+                # Значение неподходящего типа не должно сорвать весь пакет ошибкой привязки
+                if (type(operation['book_id']) is not int
+                        or not isinstance(operation['chapter_title'], str)
+                        or not isinstance(operation['selected_text'], str)
+                        or not isinstance(operation.get('note_text', ''), str)):
+                    result.update({'status': 'error', 'error': 'Некорректные данные'})
+                    continue
+                if not is_book_available(cursor, operation['book_id']):
+                    result.update({'status': 'error', 'error': 'Книга не найдена'})
+                    continue
+                try:
+                    cursor.execute('''
+                        INSERT INTO notes (book_id, chapter_title, selected_text, note_text,
+                                           chapter_index, block_id, start_offset, end_offset)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (operation['book_id'], operation['chapter_title'],
+                          operation['selected_text'], operation.get('note_text', ''),
+                          *note_anchor(operation)))
+                except sqlite3.IntegrityError:
+                    result.update({'status': 'error', 'error': 'Книга не найдена'})
+                    continue
+                result.update({'status': 'ok', 'note_id': cursor.lastrowid})
+            
+            elif operation.get('op') == 'update':
+                if type(operation.get('id')) is not int or 'note_text' not in operation:
+                    result.update({'status': 'error', 'error': 'Недостаточно данных'})
+                    continue
+                if not isinstance(operation['note_text'], str):
+                    result.update({'status': 'error', 'error': 'Некорректные данные'})
+                    continue
+                cursor.execute('UPDATE notes SET note_text = ? WHERE id = ?', (operation['note_text'], operation['id']))
+                if cursor.rowcount == 0:
+                    result.update({'status': 'error', 'error': 'Заметка не найдена'})
+                else:
+                    result.update({'status': 'ok', 'note_id': operation['id']})
+            
+            elif operation.get('op') == 'delete':
+                if type(operation.get('id')) is not int:
+                    result.update({'status': 'error', 'error': 'Недостаточно данных'})
+                    continue
+                cursor.execute('DELETE FROM notes WHERE id = ?', (operation['id'],))
+                if cursor.rowcount == 0:
+                    result.update({'status': 'error', 'error': 'Заметка не найдена'})
+                else:
+                    result.update({'status': 'ok', 'note_id': operation['id']})
+            
+            else:
+                result.update({'status': 'error', 'error': 'Неизвестная операция'})
+        
+        # Один коммит (и один fsync) на весь пакет
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Ошибка пакетной обработки заметок: {e}")
+        return jsonify({'error': 'Ошибка базы данных, изменения не сохранены'}), 500
+    
+    return jsonify({'success': True, 'results': results})
+
 @app.route('/api/notes/<int:note_id>', methods=['PUT'])
 @login_required
 def update_note(note_id):
@@ -1769,17 +4367,15 @@ def update_note(note_id):
     if not data or 'note_text' not in data:
         return jsonify({'error': 'Недостаточно данных'}), 400
     
-    conn = sqlite3.connect('books.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('UPDATE notes SET note_text = ? WHERE id = ?', (data['note_text'], note_id))
     
     if cursor.rowcount == 0:
-        conn.close()
         return jsonify({'error': 'Заметка не найдена'}), 404
     
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
@@ -1787,17 +4383,15 @@ def update_note(note_id):
 @login_required
 def delete_note(note_id):
     """Удаление заметки"""
-    conn = sqlite3.connect('books.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('DELETE FROM notes WHERE id = ?', (note_id,))
     
     if cursor.rowcount == 0:
-        conn.close()
         return jsonify({'error': 'Заметка не найдена'}), 404
     
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
@@ -1809,11 +4403,10 @@ def get_book_info():
     if not book_path:
         return jsonify({'error': 'Не указан путь к книге'}), 400
     
-    conn = sqlite3.connect('books.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT id, title, author FROM books WHERE site_path = ?', (book_path,))
+    cursor.execute('SELECT id, title, author FROM books WHERE site_path = ? AND deleted_at IS NULL', (book_path,))
     result = cursor.fetchone()
-    conn.close()
     
     if result:
         return jsonify({
@@ -1824,79 +4417,509 @@ def get_book_info():
     else:
         return jsonify({'error': 'Книга не найдена'}), 404
 
+@app.route('/api/books/<int:book_id>/chapters')
+@login_required
+def list_chapters(book_id):
+    """Оглавление книги с метаданными глав (без загрузки EPUB)"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT site_path FROM books WHERE id = ? AND deleted_at IS NULL', (book_id,))
+    book = cursor.fetchone()
+    if not book:
+        return jsonify({'error': 'Книга не найдена'}), 404
+    
+    cursor.execute(f'SELECT {CHAPTER_COLUMNS} FROM chapters WHERE book_id = ? ORDER BY chapter_index', (book_id,))
+    chapters = [chapter_to_dict(chapter) for chapter in cursor.fetchall()]
+    
+    return jsonify({'book_id': book_id, 'site_path': book[0], 'chapters': chapters})
+
+@app.route('/api/books/<int:book_id>/toc')
+@login_required
+def book_toc(book_id):
+    """Вложенное оглавление книги из навигации EPUB (без загрузки EPUB)"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT site_path, toc FROM books WHERE id = ? AND deleted_at IS NULL', (book_id,))
+    book = cursor.fetchone()
+    if not book:
+        return jsonify({'error': 'Книга не найдена'}), 404
+    
+    site_path, toc = book
+    cursor.execute('SELECT chapter_index, title, filename FROM chapters WHERE book_id = ? ORDER BY chapter_index', (book_id,))
+    chapters = cursor.fetchall()
+    if toc:
+        nodes = json.loads(toc)
+    else:
+        # Книги, загруженные до сохранения оглавления: плоский список глав
+        nodes = [{'title': title, 'chapter_index': index, 'fragment': None, 'children': []}
+                 for index, title, _ in chapters]
+    
+    filenames = {index: filename for index, _, filename in chapters}
+    return jsonify({'book_id': book_id, 'site_path': site_path, 'toc': toc_to_dict(nodes, site_path, filenames)})
+
+@app.route('/api/books/<int:book_id>/chapters/<int:chapter_index>/anchors')
+@login_required
+def chapter_anchors(book_id, chapter_index):
+    """Все позиционные якоря заметок главы одним запросом (для подсветки на странице)"""
+    conn = get_db()
+    cursor = conn.cursor()
+    if not is_book_available(cursor, book_id):
+        return jsonify({'error': 'Книга не найдена'}), 404
+    
+    cursor.execute('''
+        SELECT id, block_id, start_offset, end_offset, selected_text, note_text
+        FROM notes
+        WHERE book_id = ? AND chapter_index = ? AND block_id IS NOT NULL
+        ORDER BY block_id, start_offset
+    ''', (book_id, chapter_index))
+    
+    anchors = [{
+        'id': note_id,
+        'block_id': block_id,
+        'start': start_offset,
+        'end': end_offset,
+        'selected_text': selected_text,
+        'note_text': note_text
+    } for note_id, block_id, start_offset, end_offset, selected_text, note_text in cursor.fetchall()]
+    
+    return jsonify({'book_id': book_id, 'chapter_index': chapter_index, 'anchors': anchors})
+
+@app.route('/api/search')
+@login_required
+def search_chapters():
+    """Полнотекстовый поиск по содержимому всех книг
+    
+    Возвращает найденные главы по релевантности (bm25, совпадение в названии
+    главы весит больше) с фрагментами текста и ссылками на страницы глав.
+    """
+    query = build_fts_query(request.args.get('q', ''))
+    if not query:
+        return jsonify({'error': 'Пустой поисковый запрос'}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT f.book_id, b.title, b.site_path, f.chapter_index, f.title, c.filename,
+                   snippet(chapters_fts, 1, char(2), char(3), '…', 16) AS fragment,
+                   bm25(chapters_fts, 10.0, 1.0) AS score
+            FROM chapters_fts f
+            JOIN books b ON b.id = f.book_id
+            LEFT JOIN chapters c ON c.book_id = f.book_id AND c.chapter_index = f.chapter_index
+            WHERE chapters_fts MATCH ? AND b.deleted_at IS NULL
+            ORDER BY score
+            LIMIT ?
+        ''', (query, get_page_limit(20)))
+    except sqlite3.OperationalError:
+        return jsonify({'error': 'Некорректный поисковый запрос'}), 400
+    
+    from urllib.parse import quote
+    
+    results = []
+    for book_id, book_title, site_path, chapter_index, chapter_title, filename, fragment, score in cursor.fetchall():
+        results.append({
+            'book_id': book_id,
+            'book_title': book_title,
+            'chapter_index': chapter_index,
+            'chapter_title': chapter_title,
+            'snippet': format_snippet(fragment),
+            'url': quote(f"/book/{site_path}/{filename or chapter_filename(chapter_index, chapter_title)}"),
+            'score': score
+        })
+    
+    return jsonify({'query': request.args.get('q', ''), 'results': results})
+
+@app.route('/api/notes/search')
+@login_required
+def search_notes():
+    """Полнотекстовый поиск по заметкам всех книг или одной книги (book_id)"""
+    query = build_fts_query(request.args.get('q', ''))
+    if not query:
+        return jsonify({'error': 'Пустой поисковый запрос'}), 400
+    
+    book_id = request.args.get('book_id', type=int)
+    book_filter = 'AND n.book_id = ?' if book_id is not None else ''
+    params = [query] + ([book_id] if book_id is not None else []) + [get_page_limit(50)]
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'''
+            SELECT n.id, n.book_id, b.title, n.chapter_title, n.created_at,
+                   snippet(notes_fts, 0, char(2), char(3), '…', 24),
+                   snippet(notes_fts, 1, char(2), char(3), '…', 24),
+                   bm25(notes_fts) AS score
+            FROM notes_fts
+            JOIN notes n ON n.id = notes_fts.rowid
+            JOIN books b ON b.id = n.book_id
+            WHERE notes_fts MATCH ? AND b.deleted_at IS NULL {book_filter}
+            ORDER BY score
+            LIMIT ?
+        ''', params)
+    except sqlite3.OperationalError:
+        return jsonify({'error': 'Некорректный поисковый запрос'}), 400
+    
+    results = []
+    for note_id, note_book_id, book_title, chapter_title, created_at, selected, note_text, score in cursor.fetchall():
+        results.append({
+            'id': note_id,
+            'book_id': note_book_id,
+            'book_title': book_title,
+            'chapter_title': chapter_title,
+            'created_at': created_at,
+            'selected_text': format_snippet(selected or ''),
+            'note_text': format_snippet(note_text or ''),
+            'score': score
+        })
+    
+    return jsonify({'query': request.args.get('q', ''), 'results': results})
+
+def find_book_epub(site_path):
+    """Находит исходный EPUB книги - копию source.epub в папке сайта
+    
+    Книгам, загруженным до появления копии, EPUB указывается при переносе
+    (migrate-storage --epub), до этого они экспортируются только по сохраненным данным.
+    """
+    candidate = os.path.join(app.config['BOOKS_FOLDER'], site_path, SOURCE_EPUB_NAME)
+    if os.path.isfile(candidate):
+        return candidate
+    return None
+
+def load_export_source(cursor, book_id, site_path, chapter_indexes):
+    """Источник глав для экспорта: (путь к исходному EPUB или None, представление книги или None)
+    
+    Главы берутся из book_ir; без него - по таблице chapters из файлов нужных глав в EPUB.
+    Только книги без обеих таблиц (представление None) разбираются из EPUB целиком.
+    """
+    epub_path = find_book_epub(site_path)
+    ir = load_book_ir(cursor, book_id, chapter_indexes)
+    if ir is None and epub_path:
+        ir = load_chapters_outline(cursor, book_id)
+    return epub_path, ir
+
+def store_missing_book_ir(conn, book_id, ir):
+    """Сохраняет промежуточное представление, построенное экспортом по исходному EPUB
+    
+    Пока шел экспорт, книгу могли окончательно удалить - тогда представление не нужно.
+    """
+    if ir is None:
+        return
+    try:
+        save_book_ir(conn.cursor(), book_id, ir)
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+
+def export_chapter_file(processor, chapter_index, format, book_title, book_author):
+    """Экспортирует главу загруженной книги, возвращает (buffer, filename, mimetype) или None"""
+    import re
+    
+    mimetype, method_name = EXPORT_FORMATS[format]
+    with STAGE_DURATION.time(stage=f'export_{format}'):
+        buffer = getattr(processor, method_name)(chapter_index, book_title, book_author)
+    if buffer is None:
+        STAGE_ERRORS.inc(stage=f'export_{format}')
+        return None
+    
+    EXPORT_BYTES.inc(buffer.getbuffer().nbytes, format=format)
+    
+    safe_title = re.sub(r'[<>:"/\\|?*]', '', processor.chapters[chapter_index]['title'])
+    return buffer, f"{safe_title}.{format}", mimetype
+
 @app.route('/download-chapter/<int:book_id>/<int:chapter_index>/<format>')
 @login_required
+@admission_controlled('export')
 def download_chapter(book_id, chapter_index, format):
     """Скачивание главы в указанном формате"""
-    import re
-    
-    if format not in ['epub', 'docx']:
+    if format not in EXPORT_FORMATS:
         return jsonify({'error': 'Неподдерживаемый формат'}), 400
     
     # Получаем информацию о книге
-    conn = sqlite3.connect('books.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT title, author, site_path FROM books WHERE id = ?', (book_id,))
+    cursor.execute('SELECT title, author, site_path, chapters_count FROM books WHERE id = ? AND deleted_at IS NULL', (book_id,))
     result = cursor.fetchone()
-    conn.close()
     
     if not result:
         return jsonify({'error': 'Книга не найдена'}), 404
     
-    book_title, book_author, site_path = result
+    book_title, book_author, site_path, chapters_count = result
     
-    # Находим оригинальный EPUB файл
-    epub_files = []
-    for file in os.listdir(app.config['BOOKS_FOLDER']):
-        if file.endswith('.epub'):
-            epub_files.append(file)
+    # Несуществующую главу отклоняем до загрузки книги
+    if chapter_index >= chapters_count:
+        return jsonify({'error': 'Глава не найдена'}), 404
     
-    if not epub_files:
+    # Глава берется из промежуточного представления, без него - из оригинального EPUB
+    epub_path, ir = load_export_source(cursor, book_id, site_path, [chapter_index])
+    if ir is None and not epub_path:
         return jsonify({'error': 'Оригинальный EPUB файл не найден'}), 404
     
-    # Берем первый найденный EPUB (можно улучшить логику)
-    epub_path = os.path.join(app.config['BOOKS_FOLDER'], epub_files[0])
+    # Экспорт может идти до EXPORT_TIMEOUT: соединение на это время возвращается в пул
+    release_db_early()
     
-    # Загружаем EPUB и экспортируем главу
-    processor = EPUBProcessor()
-    if not processor.load_epub(epub_path):
-        return jsonify({'error': 'Ошибка при загрузке EPUB файла'}), 500
+    # Экспортируем главу в дочернем процессе
+    try:
+        (exported,), new_ir = run_sandboxed(export_chapters, epub_path, book_title, book_author,
+                                            [(chapter_index, format)], ir, timeout=app.config['EXPORT_TIMEOUT'])
+    except SandboxError as e:
+        return jsonify({'error': f'Ошибка при экспорте главы: {e}'}), 500
+    if new_ir is not None:
+        store_missing_book_ir(get_db(), book_id, new_ir)
     
-    if chapter_index >= len(processor.chapters):
-        return jsonify({'error': 'Глава не найдена'}), 404
+    if 'error' in exported:
+        return jsonify({'error': exported['error']}), exported['status']
+    
+    return send_file(
+        io.BytesIO(exported['data']),
+        as_attachment=True,
+        download_name=exported['filename'],
+        mimetype=exported['mimetype']
+    )
+
+@app.route('/api/export/batch', methods=['POST'])
+@login_required
+@admission_controlled('export')
+def batch_export():
+    """Пакетный экспорт глав нескольких книг в один ZIP архив
     
-    chapter_title = processor.chapters[chapter_index]['title']
-    safe_title = re.sub(r'[<>:"/\\|?*]', '', chapter_title)
+    Принимает {"items": [{"book_id": 1, "chapter_index": 0, "format": "epub"}, ...]}.
+    Каждая книга загружается один раз в своем дочернем процессе, главы книги экспортируются
+    в нем параллельно. Книги обрабатываются по очереди: запрос, занявший одно место
+    в классе export, держит не больше одного дочернего процесса.
+    Ошибки отдельных глав попадают в manifest.json внутри архива.
+    """
+    import re
     
-    if format == 'docx':
-        buffer = processor.export_chapter_to_docx(chapter_index, book_title, book_author)
-        if buffer is None:
-            return jsonify({'error': 'Ошибка при создании DOCX файла'}), 500
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Не указан список глав для экспорта'}), 400
+    
+    if len(items) > app.config['BATCH_EXPORT_MAX_ITEMS']:
+        return jsonify({'error': f"Слишком много глав: максимум {app.config['BATCH_EXPORT_MAX_ITEMS']}"}), 400
+    
+    # Проверяем элементы запроса, ошибочные сразу записываем в манифест
+    manifest = []
+    valid_items = []
+    for position, item in enumerate(items):
+        entry = {'item': position}
+        if isinstance(item, dict):
+            entry.update({k: item.get(k) for k in ('book_id', 'chapter_index', 'format')})
+        manifest.append(entry)
         
-        filename = f"{safe_title}.docx"
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-        )
-    elif format == 'epub':
-        buffer = processor.export_chapter_to_epub(chapter_index, book_title, book_author)
-        if buffer is None:
-            return jsonify({'error': 'Ошибка при создании EPUB файла'}), 500
-        
-        filename = f"{safe_title}.epub"
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/epub+zip'
-        )
+        if (not isinstance(item, dict)
+                or type(item.get('book_id')) is not int
+                or type(item.get('chapter_index')) is not int
+                or item['chapter_index'] < 0):
+            entry.update({'status': 'error', 'error': 'Некорректный элемент запроса'})
+        elif item.get('format') not in EXPORT_FORMATS:
+            entry.update({'status': 'error', 'error': 'Неподдерживаемый формат'})
+        else:
+            valid_items.append(entry)
+    
+    # Информация о всех книгах одним запросом
+    book_ids = sorted({entry['book_id'] for entry in valid_items})
+    books = {}
+    if book_ids:
+        conn = get_db()
+        cursor = conn.cursor()
+        placeholders = ','.join('?' * len(book_ids))
+        cursor.execute(f'''
+            SELECT id, title, author, site_path, chapters_count FROM books
+            WHERE id IN ({placeholders}) AND deleted_at IS NULL
+        ''', book_ids)
+        rows = cursor.fetchall()
+        books = {row[0]: row[1:4] for row in rows}
+        chapters_counts = {row[0]: row[4] for row in rows}
+    
+    def export_book(book_id):
+        """Экспортирует все главы пакета из одной книги, ошибки записывает в записи манифеста"""
+        entries = [entry for entry in pending if entry['book_id'] == book_id]
+        book_title, book_author, _ = books[book_id]
+        epub_path, ir = sources[book_id]
+        if ir is None and not epub_path:
+            results = [{'error': 'Оригинальный EPUB файл не найден'}] * len(entries)
+        else:
+            try:
+                results, new_irs[book_id] = run_sandboxed(
+                    export_chapters, epub_path, book_title, book_author,
+                    [(entry['chapter_index'], entry['format']) for entry in entries], ir,
+                    timeout=app.config['EXPORT_TIMEOUT'])
+            except SandboxError as e:
+                results = [{'error': f'Ошибка при экспорте книги: {e}'}] * len(entries)
+        
+        for entry, result in zip(entries, results):
+            if 'error' in result:
+                entry.update({'status': 'error', 'error': result['error']})
+            else:
+                exported[entry['item']] = result
+    
+    for entry in valid_items:
+        if entry['book_id'] not in books:
+            entry.update({'status': 'error', 'error': 'Книга не найдена'})
+        elif entry['chapter_index'] >= chapters_counts[entry['book_id']]:
+            # Не загружаем книгу ради заведомо несуществующей главы
+            entry.update({'status': 'error', 'error': 'Глава не найдена'})
+    pending = [entry for entry in valid_items if 'status' not in entry]
+    pending_books = sorted({entry['book_id'] for entry in pending})
+    
+    # Источники глав читаются до экспорта: из промежуточных представлений только главы пакета
+    sources = {
+        book_id: load_export_source(cursor, book_id, books[book_id][2],
+                                    [entry['chapter_index'] for entry in pending if entry['book_id'] == book_id])
+        for book_id in pending_books
+    }
+    # Экспорт может идти до EXPORT_TIMEOUT: соединение на это время возвращается в пул
+    release_db_early()
+    
+    new_irs = {}
+    exported = {}
+    for book_id in pending_books:
+        export_book(book_id)
+    for book_id, ir in new_irs.items():
+        if ir is not None:
+            store_missing_book_ir(get_db(), book_id, ir)
+    
+    # Собираем архив: папка на книгу, манифест с результатом по каждому элементу
+    zip_buffer = io.BytesIO()
+    used_names = set()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as export_zip:
+        for entry in pending:
+            if entry['item'] not in exported:
+                continue
+            filename = exported[entry['item']]['filename']
+            book_folder = re.sub(r'[<>:"/\\|?*]', '', books[entry['book_id']][0]) or str(entry['book_id'])
+            name = f"{book_folder}/{entry['chapter_index'] + 1:02d}_{filename}"
+            if name in used_names:
+                name = f"{book_folder}/{entry['chapter_index'] + 1:02d}_{entry['item']}_{filename}"
+            used_names.add(name)
+            
+            export_zip.writestr(name, exported[entry['item']]['data'])
+            entry.update({'status': 'ok', 'file': name})
+        
+        export_zip.writestr('manifest.json', json.dumps({
+            'total': len(manifest),
+            'succeeded': sum(1 for entry in manifest if entry.get('status') == 'ok'),
+            'failed': sum(1 for entry in manifest if entry.get('status') == 'error'),
+            'items': manifest
+        }, ensure_ascii=False, indent=2))
+    
+    zip_buffer.seek(0)
+    return send_file(
+        zip_buffer,
+        as_attachment=True,
+        download_name='chapters.zip',
+        mimetype='application/zip'
+    )
+
+@app.route('/api/admission')
+@login_required
+def admission_status():
+    """Текущая загрузка и длина очередей тяжелых операций"""
+    return jsonify({name: get_admission_controller(name).stats() for name in ADMISSION_CLASSES})
+
+@app.cli.command('reindex-search')
+def reindex_search_command():
+    """Перестраивает полнотекстовый индекс, метаданные глав и обложки всех книг
+    
+    Книги берутся из промежуточного представления; книги без него (или с представлением
+    прежней версии) разбираются по исходному EPUB, и представление сохраняется.
+    """
+    with get_db_pool().connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, title, site_path FROM books WHERE deleted_at IS NULL ORDER BY id')
+        for book_id, title, site_path in cursor.fetchall():
+            epub_path = find_book_epub(site_path)
+            processor = EPUBProcessor()
+            ir = load_book_ir(cursor, book_id)
+            if ir is not None:
+                processor.load_ir(ir, epub_path)
+            elif not epub_path or not processor.load_epub(epub_path):
+                print(f"Пропущена книга {book_id} ({title}): исходный EPUB недоступен")
+                continue
+            else:
+                save_book_ir(cursor, book_id, processor.to_ir())
+            save_book_chapters(cursor, book_id, processor)
+            save_book_toc(cursor, book_id, processor)
+            index_book_chapters(cursor, book_id, processor.chapters)
+            if ir is not None and processor.cover_path:
+                # Для миниатюр из EPUB читается только обложка
+                try:
+                    processor.load_images([processor.cover_path])
+                except Exception as e:
+                    print(f"Не удалось прочитать обложку книги {book_id} ({title}): {e}")
+            # Недоступная обложка не стирает уже созданные миниатюры
+            if not processor.cover_path or processor.cover_path in processor.images:
+                covers = processor.create_cover_thumbnails(app.config['COVERS_FOLDER']) or {}
+                cursor.execute('UPDATE books SET cover_small = ?, cover_large = ? WHERE id = ?',
+                               (covers.get('small'), covers.get('large'), book_id))
+            conn.commit()
+            print(f"Проиндексирована книга {book_id} ({title}): {len(processor.chapters)} глав")
+
+@app.cli.command('migrate-storage')
+@click.option('--epub', 'epubs', multiple=True, metavar='ID=ПУТЬ',
+              help='Исходный EPUB книги без source.epub (можно указать несколько раз)')
+def migrate_storage_command(epubs):
+    """Переносит сайты книг из books/<название> в books/ab/cd/<ключ>
+    
+    Старым книгам без source.epub копия исходного EPUB делается только из явно
+    указанного файла: угадывать его по содержимому books/ нельзя.
+    """
+    epub_paths = {}
+    for item in epubs:
+        book_id, _, path = item.partition('=')
+        if not book_id.isdigit() or not os.path.isfile(path):
+            raise click.BadParameter(f'ожидается ID=путь к существующему EPUB: {item}', param_hint='--epub')
+        epub_paths[int(book_id)] = path
+    
+    books_folder = Path(app.config['BOOKS_FOLDER'])
+    with get_db_pool().connection() as conn:
+        rows = conn.execute('SELECT id, title, site_path FROM books WHERE deleted_at IS NULL ORDER BY id').fetchall()
+        for book_id, title, site_path in rows:
+            if is_storage_path(site_path):
+                copy_legacy_epub(book_id, title, books_folder / site_path, epub_paths.get(book_id))
+                continue
+            
+            new_path = book_storage_path(site_path)
+            source, target = books_folder / site_path, books_folder / new_path
+            with site_lock(source, books_folder):
+                # Папка уже перенесена прерванным запуском - остается обновить запись
+                if source.exists():
+                    if target.exists():
+                        print(f"Пропущена книга {book_id} ({title}): папка {new_path} уже занята")
+                        continue
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    os.rename(source, target)
+                conn.execute('UPDATE books SET site_path = ? WHERE id = ?', (new_path, book_id))
+                conn.commit()
+            print(f"Перенесена книга {book_id} ({title}): {site_path} -> {new_path}")
+            copy_legacy_epub(book_id, title, target, epub_paths.get(book_id))
+
+def copy_legacy_epub(book_id, title, site, epub_path):
+    """Копирует указанный исходный EPUB в папку сайта книги, у которой нет source.epub"""
+    if not site.is_dir() or (site / SOURCE_EPUB_NAME).exists():
+        return
+    if epub_path:
+        shutil.copyfile(epub_path, site / SOURCE_EPUB_NAME)
+        print(f"Книге {book_id} ({title}) скопирован исходный EPUB: {epub_path}")
+    else:
+        print(f"У книги {book_id} ({title}) нет исходного EPUB: экспорт только по сохраненным данным, "
+              f"укажите файл через --epub {book_id}=путь")
+
+@app.cli.command('empty-trash')
+def empty_trash_command():
+    """Сразу удаляет книги из корзины (без ожидания фонового сборщика)"""
+    print(f"Удалено книг из корзины: {reap_trash()}")
 
 if __name__ == '__main__':
     # Инициализируем базу данных
     init_db()
     
+    # Убираем следы прерванных сборок сайтов и дочищаем корзину
+    cleanup_site_builds()
+    wake_trash_reaper()
+    
     # Запускаем приложение
     print("=== Запуск EPUB Cutter Web App ===")
     print("Откройте браузер и перейдите по адресу: http://localhost:5000")
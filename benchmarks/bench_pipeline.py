@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк конвейера обработки EPUB
+Замеряет load_epub, create_website, export_chapter_to_epub и export_chapter_to_docx
+на синтетических книгах разного размера, сохраняет результат в JSON
+
+Пример:
+    python benchmarks/bench_pipeline.py --profiles small medium --output before.json
+    python benchmarks/bench_pipeline.py --compare before.json --output after.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.epub_generator import generate_epub
+
+# Профили книг: параметры generate_epub
+PROFILES = {
+    'small': dict(chapters=10, chapter_words=1000, images=2, image_size=128, link_density=2.0),
+    'medium': dict(chapters=40, chapter_words=3000, images=20, image_size=256, link_density=2.0),
+    'large': dict(chapters=150, chapter_words=5000, images=60, image_size=512, link_density=2.0),
+    'links': dict(chapters=60, chapter_words=3000, images=0, link_density=20.0),
+    'malformed': dict(chapters=40, chapter_words=3000, images=5, image_size=128, malformed_ratio=0.3),
+}
+
+OPERATIONS = ('load_epub', 'create_website', 'export_chapter_to_epub', 'export_chapter_to_docx')
+
+def import_app(workdir):
+    """Импортирует app.py так, чтобы служебные папки создавались во временном каталоге"""
+    previous = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import app
+    finally:
+        os.chdir(previous)
+    return app
+
+def git_revision():
+    """Текущий коммит репозитория (для сравнения результатов между коммитами)"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=REPO_ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def export_indexes(chapters, count):
+    """Равномерно распределенные по книге главы для экспорта"""
+    if chapters <= count:
+        return list(range(chapters))
+    step = (chapters - 1) / (count - 1) if count > 1 else 0
+    return sorted({round(i * step) for i in range(count)})
+
+def make_operation(app, name, epub_path, workdir, chapter_indexes):
+    """Возвращает (подготовка, замеряемая функция) для операции
+
+    Подготовка выполняется вне замера: например, загрузка книги перед экспортом.
+    """
+    state = {}
+
+    def load_processor():
+        processor = app.EPUBProcessor()
+        if not processor.load_epub(epub_path):
+            raise RuntimeError(f'Не удалось загрузить {epub_path}')
+        state['processor'] = processor
+
+    if name == 'load_epub':
+        return lambda: None, load_processor
+
+    if name == 'create_website':
+        def prepare():
+            load_processor()
+            output = os.path.join(workdir, 'sites')
+            shutil.rmtree(output, ignore_errors=True)
+            os.makedirs(output)
+            state['output'] = output
+
+        def run():
+            if state['processor'].create_website(state['output']) is None:
+                raise RuntimeError('create_website вернул None')
+        return prepare, run
+
+    def run_export():
+        processor = state['processor']
+        method = getattr(processor, name)
+        for index in chapter_indexes:
+            if method(index, processor.book_title, processor.book_author) is None:
+                raise RuntimeError(f'{name} вернул None для главы {index}')
+    return load_processor, run_export
+
+def measure(prepare, run, repeat):
+    """Время (по каждому повтору) и пиковая память (отдельным прогоном под tracemalloc)"""
+    times = []
+    for _ in range(repeat):
+        prepare()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    # tracemalloc заметно замедляет код, поэтому память меряется отдельно от времени
+    prepare()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+def bench_profile(app, profile_name, params, repeat, export_chapters, workdir):
+    """Замеряет все операции на одной синтетической книге"""
+    epub_path = os.path.join(workdir, f'{profile_name}.epub')
+    book = generate_epub(epub_path, title=f'Бенчмарк {profile_name}', **params)
+    size = os.path.getsize(epub_path)
+    chapter_indexes = export_indexes(params['chapters'], export_chapters)
+
+    results = []
+    for operation in OPERATIONS:
+        prepare, run = make_operation(app, operation, epub_path, workdir, chapter_indexes)
+        # Отладочный вывод приложения (print для каждой ссылки) не должен попадать в консоль
+        with contextlib.redirect_stdout(io.StringIO()):
+            times, peak = measure(prepare, run, repeat)
+
+        median = statistics.median(times)
+        units = len(chapter_indexes) if operation.startswith('export_') else params['chapters']
+        results.append({
+            'operation': operation,
+            'times': times,
+            'median_seconds': median,
+            'min_seconds': min(times),
+            'chapters': units,
+            'chapters_per_second': units / median if median else None,
+            'megabytes_per_second': size / 1024 / 1024 / median if median and not operation.startswith('export_') else None,
+            'peak_memory_bytes': peak,
+        })
+        print(f"  {operation:<24} медиана {median * 1000:9.1f} мс  "
+              f"пик памяти {peak / 1024 / 1024:7.1f} МБ")
+
+    return {'profile': profile_name, 'book': book, 'epub_bytes': size, 'results': results}
+
+def compare(current, baseline_path):
+    """Печатает отношение медиан текущего прогона к сохраненному"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    previous = {
+        (profile['profile'], result['operation']): result
+        for profile in baseline['profiles'] for result in profile['results']
+    }
+    print(f"\nСравнение с {baseline_path} (коммит {baseline.get('revision')}):")
+    for profile in current['profiles']:
+        for result in profile['results']:
+            old = previous.get((profile['profile'], result['operation']))
+            if not old:
+                continue
+            ratio = result['median_seconds'] / old['median_seconds'] if old['median_seconds'] else float('inf')
+            memory = result['peak_memory_bytes'] / old['peak_memory_bytes'] if old['peak_memory_bytes'] else float('inf')
+            print(f"  {profile['profile']:<10} {result['operation']:<24} "
+                  f"время x{ratio:5.2f}  память x{memory:5.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк конвейера обработки EPUB')
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=['small', 'medium'],
+                        help='Профили книг для замера')
+    parser.add_argument('--repeat', type=int, default=3, help='Повторов каждой операции')
+    parser.add_argument('--export-chapters', type=int, default=3, help='Глав для замера экспорта')
+    parser.add_argument('--output', help='Файл для сохранения результатов в JSON')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='epub-bench-')
+    try:
+        app = import_app(workdir)
+        report = {
+            'revision': git_revision(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'profiles': [],
+        }
+        for profile_name in args.profiles:
+            print(f"Профиль {profile_name}: {PROFILES[profile_name]}")
+            report['profiles'].append(
+                bench_profile(app, profile_name, PROFILES[profile_name], args.repeat,
+                              args.export_chapters, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.output}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == '__main__':
+    main()
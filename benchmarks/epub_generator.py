@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Генератор синтетических EPUB книг для бенчмарков
+Размер книги, число изображений, плотность ссылок и доля "сломанных"
+комментариев (как в документах, сохраненных из MS Word) задаются параметрами
+"""
+
+import argparse
+import random
+import struct
+import zipfile
+import zlib
+from html import escape
+
+CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+    <rootfiles>
+        <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+    </rootfiles>
+</container>'''
+
+# Словарь для текста глав: кириллица и латиница, как в реальных книгах
+WORDS = (
+    'книга глава текст страница читатель автор история время человек слово '
+    'дорога город утро вечер свет тень море ветер дом окно '
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do'
+).split()
+
+# Некорректные комментарии, которые load_epub исправляет перед разбором XML
+MALFORMED_COMMENTS = (
+    '<!--[if gte mso 9]><xml><o:OfficeDocumentSettings/></xml><![endif]---->',
+    '<!--[endif]---->',
+    '<!-- комментарий редактора ---->',
+)
+
+def make_png(width, height, seed=0):
+    """Создает PNG изображение заданного размера (несжимаемый шум, чтобы размер был честным)"""
+    rng = random.Random(seed)
+    raw = b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(chunk_type, data):
+        return (struct.pack('>I', len(data)) + chunk_type + data
+                + struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b''))
+
+def make_paragraph(rng, words):
+    """Абзац из случайных слов с небольшим форматированием"""
+    text = [rng.choice(WORDS) for _ in range(words)]
+    if words > 6:
+        position = rng.randrange(words - 2)
+        text[position] = f'<b>{text[position]}</b>'
+        text[position + 2] = f'<i>{text[position + 2]}</i>'
+    return '<p>' + ' '.join(text).capitalize() + '.</p>'
+
+def make_chapter(index, chapters, chapter_words, images, link_density, malformed_ratio, rng):
+    """XHTML одной главы
+
+    link_density - внутренних ссылок на 1000 слов, malformed_ratio - доля абзацев,
+    за которыми следует некорректный комментарий.
+    """
+    title = f'Глава {index + 1}'
+    body = [f'<h1>{escape(title)}</h1>']
+
+    words_left = chapter_words
+    paragraph = 0
+    links_left = max(0, round(chapter_words * link_density / 1000))
+    while words_left > 0:
+        words = min(words_left, rng.randint(40, 120))
+        body.append(make_paragraph(rng, words))
+        words_left -= words
+        paragraph += 1
+
+        if links_left and rng.random() < 0.5:
+            target = rng.randrange(chapters)
+            body.append(f'<p><a href="ch{target:04d}.xhtml#p{paragraph}">См. главу {target + 1}</a></p>')
+            links_left -= 1
+        if malformed_ratio and rng.random() < malformed_ratio:
+            body.append(rng.choice(MALFORMED_COMMENTS))
+
+    # Оставшиеся ссылки добавляем в конец главы
+    for _ in range(links_left):
+        target = rng.randrange(chapters)
+        body.append(f'<p><a href="../Text/ch{target:04d}.xhtml">Глава {target + 1}</a></p>')
+
+    for image in images:
+        body.append(f'<p><img src="../Images/{image}" alt="{image}"/></p>')
+
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>{escape(title)}</title></head>
+<body>
+{chr(10).join(body)}
+</body>
+</html>'''
+
+def generate_epub(path, chapters=10, chapter_words=2000, images=5, image_size=256,
+                  link_density=2.0, malformed_ratio=0.0, title=None, seed=0):
+    """Создает EPUB файл и возвращает словарь с его параметрами
+
+    images - общее число изображений (распределяются по главам по кругу),
+    image_size - сторона квадратного изображения в пикселях.
+    """
+    rng = random.Random(seed)
+    title = title or f'Синтетическая книга {chapters}x{chapter_words}'
+    image_names = [f'image_{i:04d}.png' for i in range(images)]
+
+    manifest = []
+    spine = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as epub_zip:
+        epub_zip.writestr('mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
+        epub_zip.writestr('META-INF/container.xml', CONTAINER_XML)
+
+        for i, name in enumerate(image_names):
+            epub_zip.writestr(f'OEBPS/Images/{name}', make_png(image_size, image_size, seed + i))
+            manifest.append(f'<item id="img{i}" href="Images/{name}" media-type="image/png"/>')
+
+        for i in range(chapters):
+            chapter_images = image_names[i::chapters] if chapters else []
+            content = make_chapter(i, chapters, chapter_words, chapter_images,
+                                   link_density, malformed_ratio, rng)
+            epub_zip.writestr(f'OEBPS/Text/ch{i:04d}.xhtml', content)
+            manifest.append(f'<item id="ch{i}" href="Text/ch{i:04d}.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="ch{i}"/>')
+
+        cover = '<meta name="cover" content="img0"/>' if image_names else ''
+        epub_zip.writestr('OEBPS/content.opf', f'''<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">
+    <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+        <dc:identifier id="bookid">synthetic-{seed}-{chapters}-{chapter_words}</dc:identifier>
+        <dc:title>{escape(title)}</dc:title>
+        <dc:creator>Генератор бенчмарков</dc:creator>
+        <dc:language>ru</dc:language>
+        {cover}
+    </metadata>
+    <manifest>
+        {chr(10).join(manifest)}
+    </manifest>
+    <spine>
+        {chr(10).join(spine)}
+    </spine>
+</package>''')
+
+    return {
+        'title': title,
+        'chapters': chapters,
+        'chapter_words': chapter_words,
+        'images': images,
+        'image_size': image_size,
+        'link_density': link_density,
+        'malformed_ratio': malformed_ratio,
+        'seed': seed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Генератор синтетических EPUB книг')
+    parser.add_argument('output', help='Путь к создаваемому EPUB файлу')
+    parser.add_argument('--chapters', type=int, default=10, help='Число глав')
+    parser.add_argument('--chapter-words', type=int, default=2000, help='Слов в главе')
+    parser.add_argument('--images', type=int, default=5, help='Всего изображений')
+    parser.add_argument('--image-size', type=int, default=256, help='Сторона изображения в пикселях')
+    parser.add_argument('--link-density', type=float, default=2.0, help='Внутренних ссылок на 1000 слов')
+    parser.add_argument('--malformed-ratio', type=float, default=0.0,
+                        help='Доля абзацев с некорректным комментарием после них (0..1)')
+    parser.add_argument('--title', help='Название книги')
+    parser.add_argument('--seed', type=int, default=0, help='Зерно генератора случайных чисел')
+    args = parser.parse_args()
+
+    generate_epub(args.output, chapters=args.chapters, chapter_words=args.chapter_words,
+                  images=args.images, image_size=args.image_size, link_density=args.link_density,
+                  malformed_ratio=args.malformed_ratio, title=args.title, seed=args.seed)
+    print(f"Создан {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест локального экземпляра EPUB Cutter
+Группы клиентов (читатели, загрузчики, экспорт) работают в отдельных потоках
+с заданной частотой действий; по каждому действию считаются p50/p95/p99
+задержки, пропускная способность и коды ответов
+
+Сценарий задается JSON файлом (см. DEFAULT_SCENARIO), например:
+    python benchmarks/loadtest.py --scenario readers.json --duration 120 --output run.json
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.epub_generator import generate_epub
+
+# Сценарий по умолчанию: много читателей, редкие загрузки и скачивания глав.
+# rate - действий в секунду на одного клиента, weight - относительная частота действия
+DEFAULT_SCENARIO = {
+    'base_url': 'http://127.0.0.1:5000',
+    'username': 'reading',
+    'password': 'readingbooks',
+    'duration': 60,
+    'groups': [
+        {
+            'name': 'reader',
+            'clients': 20,
+            'rate': 2.0,
+            'actions': {'read_chapter': 10, 'image': 5, 'book_info': 3, 'save_note': 1},
+        },
+        {
+            'name': 'uploader',
+            'clients': 1,
+            'rate': 0.05,
+            'actions': {'upload': 1},
+            'book': {'chapters': 30, 'chapter_words': 2000, 'images': 10},
+        },
+        {
+            'name': 'exporter',
+            'clients': 2,
+            'rate': 0.2,
+            'actions': {'download_epub': 1, 'download_docx': 1},
+        },
+    ],
+}
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class Stats:
+    """Задержки и коды ответов по действиям, общие для всех потоков"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def record(self, action, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(action, []).append(seconds)
+            counts = self.statuses.setdefault(action, {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def record_error(self, action, error):
+        with self._lock:
+            self.errors.setdefault(action, {}).setdefault(str(error), 0)
+            self.errors[action][str(error)] += 1
+
+    def report(self, duration):
+        """Сводка по действиям: количество, пропускная способность, перцентили, коды"""
+        with self._lock:
+            result = {}
+            for action, values in sorted(self.latencies.items()):
+                values = sorted(values)
+                result[action] = {
+                    'requests': len(values),
+                    'throughput_rps': len(values) / duration if duration else None,
+                    'p50_ms': percentile(values, 0.50) * 1000,
+                    'p95_ms': percentile(values, 0.95) * 1000,
+                    'p99_ms': percentile(values, 0.99) * 1000,
+                    'max_ms': values[-1] * 1000,
+                    'statuses': {str(code): count for code, count in sorted(self.statuses[action].items())},
+                    'errors': self.errors.get(action, {}),
+                }
+            for action, errors in self.errors.items():
+                result.setdefault(action, {'requests': 0, 'errors': errors})
+            return result
+
+class Client:
+    """Сессия одного пользователя: cookie, вход через /login и замер запросов"""
+
+    def __init__(self, base_url, stats, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, action, path, data=None, headers=None, method=None):
+        """Выполняет запрос и записывает его задержку; возвращает (код, тело)"""
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers or {}, method=method)
+        start = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=self.timeout) as response:
+                body = response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            body = e.read()
+            status = e.code
+        except (urllib.error.URLError, OSError) as e:
+            self.stats.record_error(action, e)
+            return None, b''
+        self.stats.record(action, time.perf_counter() - start, status)
+        return status, body
+
+    def login(self, username, password):
+        data = urllib.parse.urlencode({'username': username, 'password': password}).encode()
+        req = urllib.request.Request(self.base_url + '/login', data=data)
+        with self.opener.open(req, timeout=self.timeout) as response:
+            if urllib.parse.urlparse(response.geturl()).path.startswith('/login'):
+                raise RuntimeError('Не удалось войти: неверный логин или пароль')
+
+    def get_json(self, action, path):
+        status, body = self.request(action, path)
+        return json.loads(body) if status == 200 else None
+
+class Library:
+    """Книги и главы сервера, известные клиентам (обновляется после загрузок)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.books = []
+        self.images = {}
+
+    def refresh(self, client):
+        books = []
+        cursor = None
+        while True:
+            query = f'?cursor={urllib.parse.quote(cursor)}' if cursor else ''
+            page = client.get_json('catalog', f'/api/books{query}')
+            if not page:
+                break
+            for book in page['books']:
+                chapters = client.get_json('chapters', f"/api/books/{book['id']}/chapters")
+                if chapters and chapters['chapters']:
+                    book['chapters'] = chapters['chapters']
+                    books.append(book)
+            cursor = page.get('next_cursor')
+            if not cursor:
+                break
+        with self._lock:
+            self.books = books
+
+    def random_chapter(self, rng):
+        with self._lock:
+            if not self.books:
+                return None, None
+            book = rng.choice(self.books)
+        return book, rng.choice(book['chapters'])
+
+def book_url(book, filename):
+    return '/book/' + urllib.parse.quote(book['site_path']) + '/' + urllib.parse.quote(filename)
+
+def encode_multipart(field, filename, content):
+    """Тело multipart/form-data с одним файлом"""
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        'Content-Type: application/epub+zip\r\n\r\n'
+    ).encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+def run_action(action, client, library, rng, context):
+    """Выполняет одно действие сценария"""
+    if action == 'upload':
+        body, content_type = encode_multipart('file', 'loadtest.epub', context['epub'])
+        status, _ = client.request('upload', '/upload', data=body, headers={'Content-Type': content_type})
+        if status == 200:
+            library.refresh(client)
+        return
+
+    book, chapter = library.random_chapter(rng)
+    if book is None:
+        return
+
+    if action == 'read_chapter':
+        status, body = client.request('read_chapter', book_url(book, chapter['filename']))
+        if status == 200:
+            images = re.findall(rb'<img[^>]*src="(images/[^"]+)"', body)
+            if images:
+                library.images[book['id']] = [image.decode() for image in images]
+    elif action == 'image':
+        images = library.images.get(book['id'])
+        if images:
+            client.request('image', book_url(book, rng.choice(images)))
+        else:
+            client.request('read_chapter', book_url(book, 'index.html'))
+    elif action == 'book_info':
+        client.request('book_info', '/api/book-info?path=' + urllib.parse.quote(book['site_path']))
+    elif action == 'save_note':
+        note = {
+            'book_id': book['id'],
+            'chapter_title': chapter['title'],
+            'chapter_index': chapter['chapter_index'],
+            'selected_text': 'Нагрузочный тест',
+            'note_text': f'Заметка {uuid.uuid4().hex[:8]}',
+        }
+        client.request('save_note', '/api/notes', data=json.dumps(note).encode(),
+                       headers={'Content-Type': 'application/json'})
+    elif action in ('download_epub', 'download_docx'):
+        format = action.split('_', 1)[1]
+        client.request(action, f"/download-chapter/{book['id']}/{chapter['chapter_index']}/{format}")
+    else:
+        raise ValueError(f'Неизвестное действие: {action}')
+
+def client_loop(group, scenario, library, stats, deadline, seed, workdir):
+    """Поток одного клиента: вход и действия с частотой rate до истечения времени"""
+    rng = random.Random(seed)
+    client = Client(scenario['base_url'], stats)
+    try:
+        client.login(scenario['username'], scenario['password'])
+    except Exception as e:
+        stats.record_error('login', e)
+        return
+
+    context = {}
+    if 'upload' in group['actions']:
+        path = os.path.join(workdir, f'{group["name"]}-{seed}.epub')
+        generate_epub(path, title=f'Нагрузочный тест {group["name"]} {seed}', seed=seed,
+                      **group.get('book', {}))
+        with open(path, 'rb') as f:
+            context['epub'] = f.read()
+
+    actions = list(group['actions'])
+    weights = [group['actions'][action] for action in actions]
+    interval = 1.0 / group['rate']
+
+    # Случайный сдвиг старта, чтобы клиенты не шли в ногу
+    next_time = time.monotonic() + rng.uniform(0, interval)
+    while True:
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if time.monotonic() >= deadline:
+            break
+        run_action(rng.choices(actions, weights)[0], client, library, rng, context)
+        # Открытая модель нагрузки: следующее действие по расписанию, а не после ответа
+        next_time += rng.expovariate(1.0 / interval)
+
+def run_scenario(scenario):
+    """Запускает все группы клиентов и возвращает отчет"""
+    stats = Stats()
+    library = Library()
+    workdir = tempfile.mkdtemp(prefix='epub-loadtest-')
+
+    setup_client = Client(scenario['base_url'], stats)
+    setup_client.login(scenario['username'], scenario['password'])
+    library.refresh(setup_client)
+    print(f"Книг на сервере: {len(library.books)}")
+
+    threads = []
+    seed = 0
+    start = time.monotonic()
+    deadline = start + scenario['duration']
+    for group in scenario['groups']:
+        for _ in range(group['clients']):
+            seed += 1
+            thread = threading.Thread(target=client_loop, daemon=True,
+                                      args=(group, scenario, library, stats, deadline, seed, workdir))
+            thread.start()
+            threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - start
+
+    return {
+        'scenario': scenario,
+        'duration_seconds': duration,
+        'actions': stats.report(duration),
+    }
+
+def print_report(report):
+    print(f"\nДлительность: {report['duration_seconds']:.1f} с")
+    print(f"{'действие':<16}{'запросов':>10}{'rps':>9}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}  коды")
+    for action, row in report['actions'].items():
+        if not row['requests']:
+            print(f"{action:<16}{0:>10}  ошибки: {row['errors']}")
+            continue
+        statuses = ' '.join(f'{code}:{count}' for code, count in row['statuses'].items())
+        print(f"{action:<16}{row['requests']:>10}{row['throughput_rps']:>9.2f}"
+              f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}  {statuses}")
+        if row['errors']:
+            print(f"{'':<16}ошибки: {row['errors']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест EPUB Cutter')
+    parser.add_argument('--scenario', help='JSON файл сценария (по умолчанию встроенный)')
+    parser.add_argument('--base-url', help='Адрес сервера')
+    parser.add_argument('--duration', type=float, help='Длительность в секундах')
+    parser.add_argument('--output', help='Файл для сохранения отчета в JSON')
+    parser.add_argument('--print-scenario', action='store_true', help='Вывести сценарий по умолчанию и выйти')
+    args = parser.parse_args()
+
+    if args.print_scenario:
+        print(json.dumps(DEFAULT_SCENARIO, ensure_ascii=False, indent=2))
+        return
+
+    scenario = dict(DEFAULT_SCENARIO)
+    if args.scenario:
+        with open(args.scenario, encoding='utf-8') as f:
+            scenario.update(json.load(f))
+    if args.base_url:
+        scenario['base_url'] = args.base_url
+    if args.duration:
+        scenario['duration'] = args.duration
+
+    report = run_scenario(scenario)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nОтчет сохранен в {args.output}")
+
+if __name__ == '__main__':
+    main()
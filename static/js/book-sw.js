@@ -0,0 +1,167 @@
+/**
+ * Service worker сайта книги (шаблон)
+ *
+ * create_website копирует этот файл в папку сайта как sw.js и дописывает
+ * в начало константу BOOK:
+ *   version - хэш содержимого сайта, от него зависит имя кэша;
+ *   shell   - файлы, кэшируемые при установке (оглавление и стили);
+ *   pages   - страница -> изображения на ней (для предзагрузки следующей главы);
+ *   bytes   - размер всех файлов книги для офлайн-чтения;
+ *   offline - разрешено ли сохранять книгу целиком.
+ *
+ * Новая версия сайта дает новый sw.js: после его активации кэши прежней
+ * версии удаляются, а открытые страницы книги перезагружаются.
+ */
+
+const CACHE_PREFIX = `epub-cutter:${self.registration.scope}:`;
+const CACHE_NAME = CACHE_PREFIX + BOOK.version;
+const OFFLINE_MARKER = '__offline__';
+
+function resolve(path) {
+    return new URL(path, self.registration.scope).href;
+}
+
+function bookPaths() {
+    const paths = new Set(BOOK.shell);
+    Object.entries(BOOK.pages).forEach(([page, images]) => {
+        paths.add(page);
+        images.forEach(image => paths.add(image));
+    });
+    return [...paths];
+}
+
+const BOOK_URLS = new Set(bookPaths().map(resolve));
+
+async function cacheUrls(cache, paths) {
+    for (const path of paths) {
+        const url = resolve(path);
+        if (await cache.match(url)) {
+            continue;
+        }
+        const response = await fetch(url, { credentials: 'same-origin' });
+        // Перенаправление означает страницу входа, а не файл книги
+        if (!response.ok || response.redirected) {
+            throw new Error(`Не удалось загрузить ${path}: ${response.status}`);
+        }
+        await cache.put(url, response);
+    }
+}
+
+async function prefetchPage(page) {
+    if (!(page in BOOK.pages)) {
+        return;
+    }
+    const cache = await caches.open(CACHE_NAME);
+    try {
+        await cacheUrls(cache, [page, ...BOOK.pages[page]]);
+    } catch (error) {
+        console.log('Предзагрузка главы не удалась:', error);
+    }
+}
+
+async function cacheBook(client) {
+    const notify = message => client && client.postMessage(message);
+    if (!BOOK.offline) {
+        notify({ type: 'cache-error', message: 'Книга слишком большая для офлайн-чтения' });
+        return;
+    }
+
+    const cache = await caches.open(CACHE_NAME);
+    const paths = bookPaths();
+    try {
+        for (let i = 0; i < paths.length; i++) {
+            await cacheUrls(cache, [paths[i]]);
+            if (i % 10 === 0) {
+                notify({ type: 'cache-progress', done: i + 1, total: paths.length });
+            }
+        }
+        await cache.put(resolve(OFFLINE_MARKER), new Response('1'));
+        notify({ type: 'cache-complete' });
+    } catch (error) {
+        notify({ type: 'cache-error', message: String(error.message || error) });
+    }
+}
+
+async function reportStatus(client) {
+    const cache = await caches.open(CACHE_NAME);
+    client.postMessage({
+        type: 'status',
+        offline: Boolean(await cache.match(resolve(OFFLINE_MARKER))),
+        available: BOOK.offline,
+        bytes: BOOK.bytes
+    });
+}
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE_NAME)
+            .then(cache => cacheUrls(cache, BOOK.shell))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil((async () => {
+        const names = await caches.keys();
+        const stale = names.filter(name => name.startsWith(CACHE_PREFIX) && name !== CACHE_NAME);
+
+        // Книга была сохранена офлайн - сохраняем и новую версию
+        let wasOffline = false;
+        for (const name of stale) {
+            const cache = await caches.open(name);
+            wasOffline = wasOffline || Boolean(await cache.match(resolve(OFFLINE_MARKER)));
+            await caches.delete(name);
+        }
+
+        await self.clients.claim();
+
+        if (stale.length) {
+            // Открытые страницы показывают прежнюю версию книги
+            const windows = await self.clients.matchAll({ type: 'window' });
+            windows.forEach(client => client.postMessage({ type: 'book-updated' }));
+        }
+        if (wasOffline) {
+            // Не задерживаем активацию: запросы страниц ждут ее окончания
+            cacheBook(null);
+        }
+    })());
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') {
+        return;
+    }
+
+    const url = new URL(request.url);
+    url.search = '';
+    url.hash = '';
+    if (!BOOK_URLS.has(url.href)) {
+        return;
+    }
+
+    // Файлы книги неизменны в пределах версии: отдаем из кэша, иначе из сети с сохранением
+    event.respondWith((async () => {
+        const cache = await caches.open(CACHE_NAME);
+        const cached = await cache.match(url.href);
+        if (cached) {
+            return cached;
+        }
+        const response = await fetch(request);
+        if (response.ok && !response.redirected) {
+            cache.put(url.href, response.clone());
+        }
+        return response;
+    })());
+});
+
+self.addEventListener('message', event => {
+    const data = event.data || {};
+    if (data.type === 'prefetch') {
+        event.waitUntil(prefetchPage(data.page));
+    } else if (data.type === 'cache-book') {
+        event.waitUntil(cacheBook(event.source));
+    } else if (data.type === 'status') {
+        event.waitUntil(reportStatus(event.source));
+    }
+});
@@ -222,6 +222,53 @@ class NotificationManager {
     }
 }
 
+// Экранирование текста для вставки в HTML
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text == null ? '' : String(text);
+    return div.innerHTML.replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+}
+
+// Бесконечная прокрутка: подгружает страницы по курсору, когда sentinel попадает в зону видимости
+class InfiniteScroll {
+    constructor(sentinel, loadPage) {
+        this.sentinel = sentinel;
+        this.loadPage = loadPage;
+        this.nextCursor = sentinel.dataset.nextCursor || null;
+        this.loading = false;
+        
+        if (!this.nextCursor) {
+            sentinel.remove();
+            return;
+        }
+        
+        this.observer = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                this.loadMore();
+            }
+        }, { rootMargin: '400px' });
+        this.observer.observe(sentinel);
+    }
+    
+    async loadMore() {
+        if (this.loading || !this.nextCursor) return;
+        this.loading = true;
+        
+        try {
+            this.nextCursor = await this.loadPage(this.nextCursor);
+        } catch (error) {
+            console.error('Ошибка при загрузке страницы:', error);
+        } finally {
+            this.loading = false;
+        }
+        
+        if (!this.nextCursor) {
+            this.observer.disconnect();
+            this.sentinel.remove();
+        }
+    }
+}
+
 // Добавляем CSS для анимаций уведомлений
 const notificationStyles = document.createElement('style');
 notificationStyles.textContent = `
@@ -254,5 +301,7 @@ window.EpubCutter = {
     ApiClient,
     FileValidator,
     NotificationManager,
+    InfiniteScroll,
+    escapeHtml,
     closeAllModals
 };
\ No newline at end of file
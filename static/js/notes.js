@@ -1,8 +1,138 @@
 // Система заметок для EPUB Cutter
+
+// Очередь операций с заметками: объединяет правки и отправляет их пакетами в /api/notes/batch
+class NotesBatchQueue {
+    constructor(options = {}) {
+        this.endpoint = options.endpoint || '/api/notes/batch';
+        this.delay = options.delay || 500;        // Задержка перед отправкой, мс
+        this.maxBatch = options.maxBatch || 100;  // Максимум операций в одном запросе
+        this.pending = [];                        // [{operation, waiters}]
+        this.timer = null;
+        this.nextClientId = 1;
+        
+        // Неотправленные операции досылаем при уходе со страницы
+        window.addEventListener('pagehide', () => this.flushOnUnload());
+        document.addEventListener('visibilitychange', () => {
+            if (document.visibilityState === 'hidden') {
+                this.flushOnUnload();
+            }
+        });
+    }
+
+    create(fields) {
+        return this.enqueue({ op: 'create', client_id: `c${this.nextClientId++}`, ...fields });
+    }
+
+    update(noteId, noteText) {
+        return this.enqueue({ op: 'update', id: noteId, note_text: noteText });
+    }
+
+    remove(noteId) {
+        return this.enqueue({ op: 'delete', id: noteId });
+    }
+
+    enqueue(operation) {
+        return new Promise((resolve, reject) => {
+            const waiter = { resolve, reject };
+            if (!this.coalesce(operation, waiter)) {
+                this.pending.push({ operation, waiters: [waiter] });
+            }
+            this.schedule();
+        });
+    }
+
+    coalesce(operation, waiter) {
+        let existing;
+        if (operation.op === 'create') {
+            // Повторное сохранение того же выделения (двойной клик), а не того же текста в другом месте
+            existing = this.pending.find(item => item.operation.op === 'create' &&
+                item.operation.book_id === operation.book_id &&
+                item.operation.chapter_title === operation.chapter_title &&
+                item.operation.selected_text === operation.selected_text &&
+                item.operation.block_id === operation.block_id &&
+                item.operation.start_offset === operation.start_offset &&
+                item.operation.end_offset === operation.end_offset);
+        } else {
+            // Несколько правок одной заметки -> последняя, правка + удаление -> удаление
+            existing = this.pending.find(item => item.operation.op !== 'create' &&
+                item.operation.id === operation.id &&
+                !(item.operation.op === 'delete' && operation.op === 'update'));
+        }
+        
+        if (!existing) return false;
+        
+        if (operation.op !== 'create') {
+            existing.operation = operation;
+        }
+        existing.waiters.push(waiter);
+        return true;
+    }
+
+    schedule() {
+        clearTimeout(this.timer);
+        if (this.pending.length >= this.maxBatch) {
+            this.flush();
+        } else {
+            this.timer = setTimeout(() => this.flush(), this.delay);
+        }
+    }
+
+    async flush() {
+        clearTimeout(this.timer);
+        const batch = this.pending.splice(0, this.maxBatch);
+        if (batch.length === 0) return;
+        
+        try {
+            const response = await fetch(this.endpoint, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ operations: batch.map(item => item.operation) })
+            });
+            const data = await response.json();
+            if (!data.success) {
+                throw new Error(data.error || `HTTP ${response.status}`);
+            }
+            
+            batch.forEach((item, index) => {
+                const result = data.results[index];
+                item.waiters.forEach(waiter => {
+                    if (result && result.status === 'ok') {
+                        waiter.resolve(result);
+                    } else {
+                        waiter.reject(new Error(result ? result.error : 'Нет ответа'));
+                    }
+                });
+            });
+        } catch (error) {
+            batch.forEach(item => item.waiters.forEach(waiter => waiter.reject(error)));
+        }
+        
+        if (this.pending.length > 0) {
+            this.schedule();
+        }
+    }
+
+    flushOnUnload() {
+        if (this.pending.length === 0) return;
+        clearTimeout(this.timer);
+        
+        const operations = this.pending.splice(0).map(item => item.operation);
+        for (let i = 0; i < operations.length; i += this.maxBatch) {
+            const body = JSON.stringify({ operations: operations.slice(i, i + this.maxBatch) });
+            navigator.sendBeacon(this.endpoint, new Blob([body], { type: 'application/json' }));
+        }
+    }
+}
+
+const notesQueue = new NotesBatchQueue();
+window.notesQueue = notesQueue;
+
 class NotesSystem {
     constructor() {
         this.bookId = null;
         this.chapterTitle = null;
+        this.chapterIndex = null;
+        this.pendingAnchor = null;
         this.init();
     }
 
@@ -20,9 +150,9 @@ class NotesSystem {
     extractPageInfo() {
         // Пытаемся получить bookId из URL
         const pathParts = window.location.pathname.split('/');
-        if (pathParts.includes('book') && pathParts.length >= 3) {
-            // URL вида /book/{book_path}/{filename}
-            this.bookPath = pathParts[2];
+        if (pathParts[1] === 'book' && pathParts.length >= 4) {
+            // URL вида /book/{book_path}/{filename}, book_path может содержать '/'
+            this.bookPath = decodeURIComponent(pathParts.slice(2, -1).join('/'));
             
             // Получаем название главы из заголовка страницы
             const titleElement = document.querySelector('title');
@@ -32,8 +162,14 @@ class NotesSystem {
                 this.chapterTitle = fullTitle.split(' - ')[0] || 'Неизвестная глава';
             }
             
+            // Индекс главы записан в разметку страницы при создании сайта
+            const content = document.querySelector('.chapter-content');
+            if (content && content.dataset.chapterIndex !== undefined) {
+                this.chapterIndex = parseInt(content.dataset.chapterIndex, 10);
+            }
+            
             // Получаем bookId из данных на странице или делаем запрос
-            this.getBookIdFromPath();
+            this.getBookIdFromPath().then(() => this.loadHighlights());
         }
     }
 
@@ -84,6 +220,9 @@ class NotesSystem {
     showNoteButton(event, selectedText, selection) {
         // Удаляем существующую кнопку, если есть
         this.hideNoteButton();
+        
+        // Запоминаем позицию выделения, пока оно не сброшено кликом по кнопке
+        this.pendingAnchor = this.computeAnchor(selection.getRangeAt(0));
 
         // Создаем кнопку
         const button = document.createElement('div');
@@ -110,6 +249,105 @@ class NotesSystem {
         }, 5000);
     }
 
+    computeAnchor(range) {
+        // Якорь: блок с data-block и смещения символов внутри его текста
+        const blockOf = node => {
+            const element = node.nodeType === Node.ELEMENT_NODE ? node : node.parentElement;
+            return element ? element.closest('[data-block]') : null;
+        };
+        
+        const block = blockOf(range.startContainer);
+        if (this.chapterIndex === null || !block || block !== blockOf(range.endContainer)) {
+            return null;  // Выделение через несколько блоков хранится только текстом
+        }
+        
+        const prefix = document.createRange();
+        prefix.selectNodeContents(block);
+        prefix.setEnd(range.startContainer, range.startOffset);
+        const start = prefix.toString().length;
+        // Текст диапазона, а не selection.toString(): смещения посчитаны по нему
+        const text = range.toString();
+        
+        return {
+            chapter_index: this.chapterIndex,
+            block_id: block.dataset.block,
+            start_offset: start,
+            end_offset: start + text.length,
+            selected_text: text
+        };
+    }
+
+    async loadHighlights() {
+        if (!this.bookId || this.chapterIndex === null) return;
+        
+        try {
+            const response = await fetch(`/api/books/${this.bookId}/chapters/${this.chapterIndex}/anchors`);
+            if (!response.ok) return;
+            const data = await response.json();
+            this.applyHighlights(data.anchors || []);
+        } catch (error) {
+            console.log('Не удалось загрузить подсветку заметок:', error);
+        }
+    }
+
+    applyHighlights(anchors) {
+        // Один проход: блоки находятся по data-block, текст ищется только внутри блока
+        const blocks = new Map();
+        document.querySelectorAll('.chapter-content [data-block]').forEach(block => {
+            blocks.set(block.dataset.block, block);
+        });
+        
+        anchors.forEach(anchor => {
+            const block = blocks.get(anchor.block_id);
+            if (block) {
+                this.highlightRange(block, anchor);
+            }
+        });
+    }
+
+    highlightRange(block, anchor) {
+        // Собираем текстовые узлы, попадающие в [start, end)
+        const walker = document.createTreeWalker(block, NodeFilter.SHOW_TEXT);
+        const targets = [];
+        let text = '';
+        let node;
+        while ((node = walker.nextNode())) {
+            const nodeStart = text.length;
+            text += node.nodeValue;
+            const from = Math.max(anchor.start, nodeStart);
+            const to = Math.min(anchor.end, text.length);
+            if (from < to) {
+                targets.push([node, from - nodeStart, to - nodeStart]);
+            }
+            if (text.length >= anchor.end) break;
+        }
+        
+        // Текст блока изменился после создания заметки - не подсвечиваем.
+        // Пробелы нормализуются: старые заметки хранят текст из selection.toString()
+        const normalize = value => value.replace(/\s+/g, ' ').trim();
+        if (normalize(text.slice(anchor.start, anchor.end)) !== normalize(anchor.selected_text || '')) {
+            return;
+        }
+        
+        targets.forEach(([textNode, from, to]) => {
+            let target = textNode;
+            if (from > 0) {
+                target = target.splitText(from);
+            }
+            if (to - from < target.nodeValue.length) {
+                target.splitText(to - from);
+            }
+            const mark = document.createElement('mark');
+            mark.className = 'note-highlight';
+            mark.dataset.noteId = anchor.id;
+            if (anchor.note_text) {
+                mark.title = anchor.note_text;
+            }
+            target.parentNode.insertBefore(mark, target);
+            mark.appendChild(target);
+        });
+    }
+
     hideNoteButton() {
         const existingButton = document.getElementById('note-save-button');
         if (existingButton) {
@@ -129,34 +367,38 @@ class NotesSystem {
             return;
         }
 
+        const anchor = this.pendingAnchor;
+        this.pendingAnchor = null;
+        this.hideNoteButton();
+        
+        // Очищаем выделение
+        window.getSelection().removeAllRanges();
+
         try {
-            const response = await fetch('/api/notes', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    book_id: this.bookId,
-                    chapter_title: this.chapterTitle,
-                    selected_text: selectedText,
-                    note_text: ''
-                })
+            // Заметка уходит на сервер в составе ближайшего пакета
+            const result = await notesQueue.create({
+                book_id: this.bookId,
+                chapter_title: this.chapterTitle,
+                note_text: '',
+                ...(anchor || {}),
+                selected_text: anchor ? anchor.selected_text : selectedText
             });
-
-            const data = await response.json();
+            this.showSuccessMessage();
             
-            if (data.success) {
-                this.showSuccessMessage();
-                this.hideNoteButton();
-                
-                // Очищаем выделение
-                window.getSelection().removeAllRanges();
-            } else {
-                alert('Ошибка при сохранении заметки: ' + data.error);
+            if (anchor) {
+                const block = document.querySelector(`.chapter-content [data-block="${anchor.block_id}"]`);
+                if (block) {
+                    this.highlightRange(block, {
+                        id: result.note_id,
+                        start: anchor.start_offset,
+                        end: anchor.end_offset,
+                        selected_text: anchor.selected_text
+                    });
+                }
             }
         } catch (error) {
             console.error('Error saving note:', error);
-            alert('Ошибка при сохранении заметки');
+            alert('Ошибка при сохранении заметки: ' + error.message);
         }
     }
 
@@ -202,10 +444,12 @@ class NotesSystem {
     }
 }
 
-// Инициализируем систему заметок при загрузке страницы
+// Инициализируем систему заметок при загрузке страницы главы
 let notesSystem;
 document.addEventListener('DOMContentLoaded', function() {
-    notesSystem = new NotesSystem();
+    if (document.querySelector('.chapter-content')) {
+        notesSystem = new NotesSystem();
+    }
 });
 
 // Функция для установки bookId извне (может быть вызвана из шаблона)
@@ -0,0 +1,115 @@
+/**
+ * Офлайн-чтение сайта книги
+ * Регистрирует service worker книги (sw.js в папке сайта), в простое
+ * предзагружает следующую главу (<link rel="next">) и сохраняет всю книгу
+ * в кэш по кнопке на странице оглавления
+ */
+
+(function() {
+    if (!('serviceWorker' in navigator)) {
+        return;
+    }
+
+    const idle = window.requestIdleCallback || (callback => setTimeout(callback, 1000));
+
+    function formatMegabytes(bytes) {
+        return (bytes / 1024 / 1024).toFixed(1) + ' МБ';
+    }
+
+    function prefetchNextChapter() {
+        const next = document.querySelector('link[rel="next"]');
+        const worker = navigator.serviceWorker.controller;
+        if (!next || !worker) {
+            return;
+        }
+        // В режиме экономии трафика ничего не загружаем заранее
+        if (navigator.connection && navigator.connection.saveData) {
+            return;
+        }
+        idle(() => worker.postMessage({ type: 'prefetch', page: next.getAttribute('href') }));
+    }
+
+    function setOfflineStatus(text) {
+        const status = document.getElementById('offlineStatus');
+        if (status) {
+            status.textContent = text;
+        }
+    }
+
+    let bookBytes = 0;
+
+    async function saveBookOffline() {
+        const worker = navigator.serviceWorker.controller;
+        if (!worker) {
+            return;
+        }
+
+        // Проверяем, хватит ли места в хранилище браузера
+        if (navigator.storage && navigator.storage.estimate) {
+            const { quota, usage } = await navigator.storage.estimate();
+            if (quota && quota - usage < bookBytes) {
+                setOfflineStatus(`Недостаточно места: нужно ${formatMegabytes(bookBytes)}, доступно ${formatMegabytes(quota - usage)}`);
+                return;
+            }
+        }
+        // Просим браузер не удалять кэш при нехватке места
+        if (navigator.storage && navigator.storage.persist) {
+            navigator.storage.persist();
+        }
+
+        document.getElementById('offlineButton').disabled = true;
+        setOfflineStatus('Сохранение...');
+        worker.postMessage({ type: 'cache-book' });
+    }
+
+    navigator.serviceWorker.addEventListener('message', event => {
+        const data = event.data || {};
+        const button = document.getElementById('offlineButton');
+
+        if (data.type === 'book-updated') {
+            // Книга была загружена заново: показываем новую версию
+            window.location.reload();
+        } else if (data.type === 'status' && button) {
+            bookBytes = data.bytes;
+            document.getElementById('offlineSection').hidden = !data.available;
+            if (data.offline) {
+                button.disabled = true;
+                setOfflineStatus('Книга доступна офлайн');
+            }
+        } else if (data.type === 'cache-progress') {
+            setOfflineStatus(`Сохранение... ${data.done} из ${data.total}`);
+        } else if (data.type === 'cache-complete') {
+            setOfflineStatus('Книга доступна офлайн');
+        } else if (data.type === 'cache-error') {
+            if (button) {
+                button.disabled = false;
+            }
+            setOfflineStatus(`Ошибка сохранения: ${data.message}`);
+        }
+    });
+
+    function onControlled() {
+        prefetchNextChapter();
+        if (document.getElementById('offlineButton')) {
+            navigator.serviceWorker.controller.postMessage({ type: 'status' });
+        }
+    }
+
+    navigator.serviceWorker.register('sw.js').catch(error => {
+        console.log('Service worker книги не зарегистрирован:', error);
+    });
+
+    if (navigator.serviceWorker.controller) {
+        onControlled();
+    } else {
+        // Первое посещение: страница переходит под управление после активации
+        navigator.serviceWorker.addEventListener('controllerchange', onControlled, { once: true });
+    }
+
+    document.addEventListener('DOMContentLoaded', () => {
+        const button = document.getElementById('offlineButton');
+        if (button) {
+            button.addEventListener('click', saveBookOffline);
+        }
+    });
+})();